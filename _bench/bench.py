@@ -0,0 +1,625 @@
+from datetime import datetime, timedelta, timezone
+from base64 import b64encode
+import subprocess
+import statistics
+import importlib
+import argparse
+import tempfile
+import shutil
+import json
+import time
+import sys
+import os
+
+import stubs
+
+# Benchmarks of every function in the repo, run against the local stand-ins of
+# `stubs.py` instead of AWS and CloudFlare, e.g.:
+#
+#   python3 _bench/bench.py --output results.json
+#   python3 _bench/bench.py spot_cache_miss --latency 0.02 --baseline results.json
+#
+# Each scenario runs on a fresh interpreter, so import times are those of a
+# cold start (minus importing boto3 itself, which the stand-ins replace). Every
+# API call sleeps for `--latency` seconds, and every client takes
+# `--client-latency` seconds to be built. Services may also throttle calls over
+# a given rate, e.g. `--rate-limit lambda=10`.
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+scenarios = {}
+
+def scenario(function_name, module_name):
+    # Register a scenario, run with the handler module of `function_name`
+    def register(run):
+        scenarios[run.__name__] = (function_name, module_name, run)
+        return run
+
+    return register
+
+def measure(options, run, setup=None):
+    """Time `run` over `options['repeat']` runs, calling `setup` before each.
+
+    Only `run` is timed, and only its API calls are counted.
+    """
+    timings = []
+    calls = {}
+
+    for _ in range(options['repeat']):
+        if setup:
+            setup()
+
+        stubs.backend.reset_calls()
+
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+
+        calls = stubs.backend.reset_calls()
+
+    return {
+        'runs': len(timings),
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.mean(timings),
+        'max': max(timings),
+        'calls': calls
+    }
+
+def expect(condition, message):
+    # A scenario that doesn't do what it's meant to isn't worth timing
+    if not condition:
+        raise Exception('Unexpected result: {}'.format(message))
+
+# jenkinsSlaveLauncher
+
+@scenario('jenkinsSlaveLauncher', 'jsl')
+def spot_cache_hit(jsl, options):
+    def setup():
+        if not stubs.backend.table(jsl.spot_price_cache_table):
+            jsl.generate_spot_cache()
+
+    return measure(options, jsl.generate_spot_cache, setup)
+
+@scenario('jenkinsSlaveLauncher', 'jsl')
+def spot_cache_miss(jsl, options):
+    def setup():
+        stubs.backend.tables.clear()
+
+    def run():
+        expect(jsl.generate_spot_cache(), 'no spot prices')
+
+    return measure(options, run, setup)
+
+@scenario('jenkinsSlaveLauncher', 'jsl')
+def spot_cache_refresh(jsl, options):
+    # A new hour, with the price history of the previous one still around
+    def setup():
+        table = stubs.backend.table(jsl.spot_price_cache_table)
+
+        if not table:
+            jsl.generate_spot_cache()
+
+        for key in list(table):
+            if table[key]['timestamp']['S'] != jsl.price_history_key:
+                del table[key]
+
+    def run():
+        expect(jsl.generate_spot_cache(), 'no spot prices')
+
+    return measure(options, run, setup)
+
+# lambdaMetaDeployer
+
+def lmd_function(name):
+    return {
+        'target_function': name,
+        'artifact': {'bucket': 'bench', 'key': name + '/0.zip', 'sha': '0'},
+        'config': {'memory': 128, 'timeout': 5, 'handler': 'bench.lambda_handler'}
+    }
+
+def lmd_deploy(lmd, options, expected, setup):
+    functions = [lmd_function('bench{}'.format(i)) for i in range(options['functions'])]
+
+    def run():
+        results = lmd.lambda_handler({'action': 'deploy', 'functions': functions}, None)['results']
+        expect(set(results.values()) == {expected}, results)
+
+    return measure(options, run, lambda: setup(functions))
+
+@scenario('lambdaMetaDeployer', 'lmd')
+def lmd_create(lmd, options):
+    def setup(functions):
+        stubs.backend.functions.clear()
+        stubs.backend.tables.clear()
+
+    return lmd_deploy(lmd, options, 'created', setup)
+
+@scenario('lambdaMetaDeployer', 'lmd')
+def lmd_update(lmd, options):
+    def setup(functions):
+        lmd_deploy_once(lmd, functions)
+
+        # Cached zip hashes no longer match
+        for function in functions:
+            stubs.backend.table(lmd.kv_cache_table).pop(
+                stubs.key_of({'key': {'S': lmd.zip_cache_key(function['target_function'])}}), None
+            )
+
+    return lmd_deploy(lmd, options, 'updated', setup)
+
+@scenario('lambdaMetaDeployer', 'lmd')
+def lmd_noop(lmd, options):
+    return lmd_deploy(lmd, options, 'unchanged', lambda functions: lmd_deploy_once(lmd, functions))
+
+def lmd_deploy_once(lmd, functions):
+    lmd.lambda_handler({'action': 'deploy', 'functions': functions}, None)
+
+# jenkinsSlaveStopper, jenkinsSlaveExpirator
+
+def add_slaves(tag, count, expiration_date, register=True):
+    # Running slaves of `tag`, on both EC2 and the registry
+    launch_time = datetime.now(timezone.utc)
+    instance_ids = []
+
+    for i in range(count):
+        instance_id = 'i-{}{:08x}'.format(tag, i)
+
+        stubs.backend.instances[instance_id] = {
+            'InstanceId': instance_id,
+            'State': {'Code': 16, 'Name': 'running'},
+            'LaunchTime': launch_time,
+            'Tags': [
+                {'Key': 'jenkins_slave_tag', 'Value': tag},
+                {'Key': 'jenkins_slave_expiration_date', 'Value': str(expiration_date)}
+            ]
+        }
+
+        instance_ids.append(instance_id)
+
+    if register:
+        sys.modules['slave_registry'].register(tag, instance_ids, expiration_date)
+
+def reset_fleet():
+    stubs.backend.instances.clear()
+    stubs.backend.spot_requests.clear()
+    stubs.backend.tables.clear()
+
+@scenario('jenkinsSlaveStopper', 'jss')
+def stopper_large_fleet(jss, options):
+    def setup():
+        reset_fleet()
+        add_slaves('bench', options['fleet'], datetime.utcnow() + timedelta(hours=1))
+
+    def run():
+        report = jss.lambda_handler({'tag': 'bench'}, None)
+        expect(report['terminated'] == options['fleet'], report)
+
+    return measure(options, run, setup)
+
+@scenario('jenkinsSlaveExpirator', 'jse')
+def expirator_large_fleet(jse, options):
+    # Half the fleet is due
+    def setup():
+        reset_fleet()
+        add_slaves('due', options['fleet'] // 2, datetime.utcnow() - timedelta(minutes=1))
+        add_slaves('later', options['fleet'] - options['fleet'] // 2, datetime.utcnow() + timedelta(hours=1))
+
+    def run():
+        report = jse.lambda_handler({}, None)
+        expect(report['terminated'] == options['fleet'] // 2, report)
+
+    return measure(options, run, setup)
+
+@scenario('jenkinsSlaveExpirator', 'jse')
+def expirator_full_scan(jse, options):
+    # Same as above, but the due slaves never made it to the registry
+    def setup():
+        reset_fleet()
+        add_slaves('due', options['fleet'] // 2, datetime.utcnow() - timedelta(minutes=1), False)
+        add_slaves('later', options['fleet'] - options['fleet'] // 2, datetime.utcnow() + timedelta(hours=1))
+
+    def run():
+        report = jse.lambda_handler({'full_scan': True}, None)
+        expect(report['terminated'] == options['fleet'] // 2, report)
+
+    return measure(options, run, setup)
+
+# updateJenkinsMasterReference
+
+def add_dns_records(ujmr, external_ip, internal_ip):
+    stubs.backend.dns_records.update({
+        'record-external': {
+            'id': 'record-external', 'name': ujmr.external_name, 'type': 'A',
+            'content': external_ip, 'proxied': True
+        },
+        'record-internal': {
+            'id': 'record-internal', 'name': ujmr.internal_name, 'type': 'A',
+            'content': internal_ip, 'proxied': False
+        }
+    })
+
+@scenario('updateJenkinsMasterReference', 'ujmr')
+def ujmr_noop(ujmr, options):
+    event = {'external_ip': '192.0.2.1', 'internal_ip': '10.0.0.1'}
+
+    def setup():
+        if not stubs.backend.dns_records:
+            add_dns_records(ujmr, event['external_ip'], event['internal_ip'])
+
+    return measure(options, lambda: ujmr.lambda_handler(event, None), setup)
+
+@scenario('updateJenkinsMasterReference', 'ujmr')
+def ujmr_update(ujmr, options):
+    events = []
+
+    def setup():
+        if not stubs.backend.dns_records:
+            add_dns_records(ujmr, '192.0.2.1', '10.0.0.1')
+
+        # A new IP every run
+        events.append({
+            'external_ip': '192.0.2.{}'.format(len(events) + 2),
+            'internal_ip': '10.0.0.{}'.format(len(events) + 2)
+        })
+
+    return measure(options, lambda: ujmr.lambda_handler(events[-1], None), setup)
+
+# deploy.py
+
+def deploy_tree(options, force=False):
+    deploy = sys.modules['deploy']
+
+    def run():
+        deploy.bootstrap()
+
+        results = deploy.deploy_all(
+            deploy.scan_folders(), options['jobs'], 10, 9, force
+        )
+
+        expect(not deploy.failed(results), results)
+
+    return run
+
+def deployed_tree_setup(options):
+    deploy = sys.modules['deploy']
+    deployed = []
+
+    def setup():
+        if not deployed:
+            deploy_tree(options)()
+            deployed.append(True)
+
+    return setup
+
+@scenario('.', 'deploy')
+def deploy_full_cold(deploy, options):
+    def setup():
+        shutil.rmtree('_cache', ignore_errors=True)
+        stubs.backend.functions.clear()
+        stubs.backend.tables.clear()
+        stubs.backend.objects.clear()
+        stubs.backend.layers.clear()
+
+    return measure(options, deploy_tree(options), setup)
+
+@scenario('.', 'deploy')
+def deploy_full_unchanged(deploy, options):
+    # Every function matches the manifest, and is probed
+    return measure(options, deploy_tree(options), deployed_tree_setup(options))
+
+@scenario('.', 'deploy')
+def deploy_full_drifted(deploy, options):
+    # Every function matches the manifest, but one was deployed from elsewhere
+    ready = deployed_tree_setup(options)
+
+    def setup():
+        ready()
+
+        lmd = importlib.import_module('lmd')
+        stubs.backend.table(lmd.kv_cache_table)[
+            stubs.key_of({'key': {'S': lmd.zip_cache_key('jenkinsSlaveStopper')}})
+        ]['value'] = {'S': 'elsewhere'}
+
+    def run():
+        deploy.bootstrap()
+
+        results = deploy.deploy_all(deploy.scan_folders(), options['jobs'], 10, 9)
+        expect(results['jenkinsSlaveStopper'] == 'deployed', results)
+
+    return measure(options, run, setup)
+
+@scenario('.', 'deploy')
+def deploy_full_legacy_deployer(deploy, options):
+    # The deployer out there only takes base64 packages, until it's replaced
+    def legacy_lmd(payload):
+        if 'zip_file' not in payload:
+            raise KeyError('zip_file')
+
+        stubs.backend.call('lambda', 'UpdateFunctionCode')
+        stubs.backend.invoke_handlers['lambdaMetaDeployer'] = invoke_lmd
+
+    def setup():
+        shutil.rmtree('_cache', ignore_errors=True)
+        stubs.backend.functions.clear()
+        stubs.backend.tables.clear()
+        stubs.backend.objects.clear()
+        stubs.backend.layers.clear()
+        stubs.backend.invoke_handlers['lambdaMetaDeployer'] = legacy_lmd
+
+    def run():
+        deploy.bootstrap()
+
+        results = deploy.deploy_all(deploy.scan_folders(), options['jobs'], 10, 9)
+        expect(not deploy.failed(results), results)
+
+    return measure(options, run, setup)
+
+@scenario('.', 'deploy')
+def deploy_full_forced(deploy, options):
+    # Every function is built and deployed again, although nothing changed
+    return measure(options, deploy_tree(options, True), deployed_tree_setup(options))
+
+def stub_pip(requirements_path, target_dir):
+    # Stands in for pip, writing an empty package per requirement
+    stubs.backend.call('pip', 'install')
+
+    with open(requirements_path) as requirements_file:
+        for line in requirements_file:
+            name = line.split('#', 1)[0].split('=', 1)[0].strip()
+
+            if name:
+                os.makedirs(os.path.join(target_dir, name))
+
+                with open(os.path.join(target_dir, name, '__init__.py'), 'w'):
+                    pass
+
+def prepare_deploy(work_dir):
+    # deploy.py works on the current directory; give it a copy of the repo
+    tree = os.path.join(work_dir, 'tree')
+
+    shutil.copytree(repo_dir, tree, ignore=shutil.ignore_patterns(
+        '.git', '_cache', '_packages', '_bench', '__pycache__'
+    ))
+    os.chdir(tree)
+
+    return tree
+
+def function_paths(root, function_name):
+    # The function itself goes first, then whatever its config includes
+    paths = [os.path.join(root, function_name)]
+
+    with open(os.path.join(root, function_name, 'config.json')) as config_file:
+        for path in json.load(config_file).get('include', []):
+            paths.append(os.path.dirname(os.path.join(root, path)))
+
+    return paths
+
+def run_child(name, options, output_path):
+    """Run a single scenario (or import) and write its result to `output_path`"""
+    stubs.install(
+        options['latency'], options['service_latency'], options['client_latency'],
+        options['rate_limits']
+    )
+
+    os.environ.update({
+        'acc_number': '000000000000',
+        'UJMR_EMAIL': 'bench@example.com',
+        'UJMR_API_KEY': b64encode(b'api-key').decode('ascii')
+    })
+
+    work_dir = tempfile.mkdtemp(prefix='bench-')
+
+    try:
+        if name.startswith('import:'):
+            function_name, module_name, run = name[7:], None, None
+        else:
+            function_name, module_name, run = scenarios[name]
+
+        root = repo_dir
+
+        if function_name == '.':
+            root = prepare_deploy(work_dir)
+            stubs.backend.invoke_handlers['lambdaMetaDeployer'] = invoke_lmd
+            sys.path[:0] = [root, os.path.join(root, 'lambdaMetaDeployer'), os.path.join(root, '_lib')]
+        else:
+            sys.path[:0] = function_paths(root, function_name)
+
+        if not module_name:
+            with open(os.path.join(root, function_name, 'config.json')) as config_file:
+                module_name = json.load(config_file)['handler'].split('.')[0]
+
+        start = time.perf_counter()
+        module = importlib.import_module(module_name)
+
+        result = {
+            'function': function_name,
+            'import': time.perf_counter() - start,
+            'import_calls': stubs.backend.reset_calls()
+        }
+
+        if module_name == 'deploy':
+            module.install_dependencies = stub_pip
+
+        if run:
+            result.update(run(module, options))
+
+        with open(output_path, 'w') as output:
+            json.dump(result, output)
+    finally:
+        os.chdir(repo_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def invoke_lmd(payload):
+    # Stands in for invoking lambdaMetaDeployer, on the same backend
+    return importlib.import_module('lmd').lambda_handler(payload, None)
+
+def run_scenario(name, options):
+    with tempfile.NamedTemporaryFile(suffix='.json') as output:
+        child = subprocess.run(
+            [
+                sys.executable, os.path.abspath(__file__),
+                '--child', name, output.name,
+                '--options', json.dumps(options)
+            ],
+            stdout=None if options['verbose'] else subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            cwd=repo_dir
+        )
+
+        if child.returncode != 0:
+            return {'error': child.stderr.decode('utf-8').strip().splitlines()[-1]}
+
+        return json.load(output)
+
+def function_names():
+    # Same as deploy.py's `scan_folders()`
+    names = []
+
+    for entry in sorted(os.listdir(repo_dir)):
+        if entry.startswith('.') or entry.startswith('_'):
+            continue
+
+        if os.path.isfile(os.path.join(repo_dir, entry, 'config.json')):
+            names.append(entry)
+
+    return names
+
+def regressions(results, baseline, tolerance, noise_floor):
+    """Compare results to a previous run, returning what got slower.
+
+    Compares median run times, and import times of import-only scenarios.
+    Differences under `noise_floor` seconds are ignored.
+    """
+    found = []
+
+    for name, result in sorted(results.items()):
+        previous = baseline.get('results', {}).get(name)
+
+        if not previous or 'error' in result or 'error' in previous:
+            continue
+
+        metric = 'median' if 'median' in result else 'import'
+
+        if metric not in previous:
+            continue
+
+        if result[metric] > previous[metric] * (1 + tolerance) \
+           and result[metric] - previous[metric] > noise_floor:
+            found.append('{} {}: {:.4f}s -> {:.4f}s'.format(
+                name, metric, previous[metric], result[metric]
+            ))
+
+    return found
+
+def service_latency(value):
+    service, latency = value.split('=', 1)
+    return service, float(latency)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark functions against local stand-ins')
+    parser.add_argument(
+        'scenarios', nargs='*',
+        help='Scenarios to run (defaults to every import and scenario); '
+             'imports are named import:<function>'
+    )
+    parser.add_argument('-l', '--list', action='store_true', help='List scenarios and exit')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Runs per scenario')
+    parser.add_argument(
+        '--latency', type=float, default=0.005,
+        help='Seconds every API call takes (default: 0.005)'
+    )
+    parser.add_argument(
+        '--service-latency', type=service_latency, action='append', default=[],
+        metavar='SERVICE=SECONDS',
+        help='Latency of a single service (ec2, dynamodb, lambda, kms, s3, cloudflare, pip)'
+    )
+    parser.add_argument(
+        '--client-latency', type=float, default=0.01,
+        help='Seconds it takes to build a client (default: 0.01)'
+    )
+    parser.add_argument(
+        '--rate-limit', type=service_latency, action='append', default=[],
+        metavar='SERVICE=CALLS',
+        help='Calls per second (of each operation) a service takes before throttling'
+    )
+    parser.add_argument('--fleet', type=int, default=2000, help='Slaves on fleet scenarios')
+    parser.add_argument('--functions', type=int, default=10, help='Functions per lmd deploy')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='deploy.py --jobs')
+    parser.add_argument('-o', '--output', help='Write results to this file instead of stdout')
+    parser.add_argument('--baseline', help='Results to compare against; exits 1 on regressions')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.25,
+        help='How much slower than the baseline is a regression (default: 0.25)'
+    )
+    parser.add_argument(
+        '--noise-floor', type=float, default=0.002,
+        help='Smaller differences (in seconds) are never regressions (default: 0.002)'
+    )
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show handler output')
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    names = args.scenarios or (
+        ['import:' + name for name in function_names()] + sorted(scenarios)
+    )
+
+    if args.list:
+        print('\n'.join(names))
+        return
+
+    options = {
+        'repeat': max(args.repeat, 1),
+        'latency': args.latency,
+        'service_latency': dict(args.service_latency),
+        'client_latency': args.client_latency,
+        'rate_limits': dict(args.rate_limit),
+        'fleet': args.fleet,
+        'functions': args.functions,
+        'jobs': args.jobs,
+        'verbose': args.verbose
+    }
+
+    results = {}
+
+    for name in names:
+        print('Running {}'.format(name), file=sys.stderr)
+        results[name] = run_scenario(name, options)
+
+    report = {
+        'python': sys.version.split()[0],
+        'options': options,
+        'results': results
+    }
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    failures = [name for name, result in results.items() if 'error' in result]
+
+    for name in failures:
+        print('{} failed: {}'.format(name, results[name]['error']), file=sys.stderr)
+
+    found = []
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            found = regressions(results, json.load(baseline), args.tolerance, args.noise_floor)
+
+        for regression in found:
+            print('Regression: {}'.format(regression), file=sys.stderr)
+
+    if failures or found:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        run_child(sys.argv[2], json.loads(sys.argv[5]), sys.argv[3])
+    else:
+        main()
@@ -0,0 +1,750 @@
+import io
+import sys
+import json
+import time
+import types
+import threading
+from datetime import datetime, timedelta, timezone
+
+# Local stand-ins for the AWS services (and CloudFlare) the functions talk to,
+# installed in place of `boto3`, `botocore` and `CloudFlare` so handlers run
+# unmodified. They keep just enough state to behave like the real thing for
+# what this repo does, and sleep for a configurable latency on every call.
+
+class ClientError(Exception):
+    def __init__(self, code, message=''):
+        super(ClientError, self).__init__('{}: {}'.format(code, message))
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+class ConditionalCheckFailedException(ClientError):
+    def __init__(self):
+        super(ConditionalCheckFailedException, self).__init__('ConditionalCheckFailedException')
+
+class ResourceNotFoundException(ClientError):
+    def __init__(self, message=''):
+        super(ResourceNotFoundException, self).__init__('ResourceNotFoundException', message)
+
+class WaiterError(Exception):
+    pass
+
+class CloudFlareAPIError(Exception):
+    def __init__(self, code, message):
+        super(CloudFlareAPIError, self).__init__(message)
+        self.code = code
+
+    def __int__(self):
+        return self.code
+
+class Backend(object):
+    """State shared by every stand-in client, plus call counts and latency"""
+
+    def __init__(self, latency=0.0, service_latency=None, client_latency=0.0, rate_limits=None):
+        self.latency = latency
+        self.service_latency = service_latency or {}
+        self.client_latency = client_latency
+
+        # Calls per second (of each operation) a service takes before throttling
+        self.rate_limits = rate_limits or {}
+        self.rate_buckets = {}
+
+        self.lock = threading.Lock()
+        self.calls = {}
+
+        self.tables = {}
+        self.instances = {}
+        self.spot_requests = {}
+        self.functions = {}
+        self.layers = {}
+        self.objects = {}
+        self.dns_records = {}
+
+        # Run in place of invoked functions, by function name
+        self.invoke_handlers = {}
+
+    def call(self, service, operation):
+        # Returns whether the call was throttled
+        with self.lock:
+            name = '{}.{}'.format(service, operation)
+            throttled = self.over_rate_limit(service, name)
+
+            if throttled:
+                name += ' (throttled)'
+
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+        time.sleep(self.service_latency.get(service, self.latency))
+
+        return throttled
+
+    def over_rate_limit(self, service, name):
+        rate = self.rate_limits.get(service)
+
+        if not rate:
+            return False
+
+        now = time.monotonic()
+        tokens, updated = self.rate_buckets.get(name, (rate, now))
+        tokens = min(rate, tokens + (now - updated) * rate)
+
+        if tokens < 1:
+            self.rate_buckets[name] = (tokens, now)
+            return True
+
+        self.rate_buckets[name] = (tokens - 1, now)
+        return False
+
+    def reset_calls(self):
+        with self.lock:
+            calls, self.calls = self.calls, {}
+
+        return calls
+
+    def table(self, name):
+        return self.tables.setdefault(name, {})
+
+backend = Backend()
+
+class Events(object):
+    # Bare-bones botocore event emitter, so clients can be instrumented
+    def __init__(self):
+        self.handlers = []
+
+    def register(self, event_name, handler):
+        self.handlers.append((event_name.split('.')[0], handler))
+
+    def emit(self, event_name, **kwargs):
+        return [
+            (handler, handler(event_name=event_name, **kwargs))
+            for prefix, handler in self.handlers
+            if event_name.split('.')[0] == prefix
+        ]
+
+class Client(object):
+    """Base stand-in client; every public method counts as an API call"""
+
+    service_name = None
+
+    class exceptions(object):
+        ClientError = ClientError
+        ConditionalCheckFailedException = ConditionalCheckFailedException
+        ResourceNotFoundException = ResourceNotFoundException
+
+    def __init__(self, **kwargs):
+        self.options = kwargs
+        self.meta = types.SimpleNamespace(
+            region_name=kwargs.get('region_name'),
+            events=Events()
+        )
+
+    def api_call(self, operation):
+        context = {}
+        event_name = '{}.{}'.format(self.service_name, operation)
+
+        self.meta.events.emit('before-call.' + event_name, context=context)
+
+        # Attempts are retried for as long as a handler asks to, as botocore
+        # does (minus its own retries)
+        attempts = 0
+
+        while True:
+            attempts += 1
+
+            self.meta.events.emit('before-send.' + event_name, request=None)
+            throttled = backend.call(self.service_name, operation)
+
+            http_response = types.SimpleNamespace(status_code=429 if throttled else 200)
+            parsed = {'Error': {'Code': 'Throttling'}} if throttled else {}
+
+            delays = [
+                delay for handler, delay in self.meta.events.emit(
+                    'needs-retry.' + event_name,
+                    response=(http_response, parsed),
+                    attempts=attempts,
+                    caught_exception=None
+                )
+                if delay is not None
+            ]
+
+            if not delays:
+                break
+
+            time.sleep(delays[0])
+
+        self.meta.events.emit(
+            'after-call.' + event_name,
+            context=context, http_response=http_response, parsed=parsed
+        )
+
+        if throttled:
+            raise ClientError('Throttling', 'Rate exceeded')
+
+    def get_paginator(self, operation):
+        return Paginator(self, operation)
+
+class Paginator(object):
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        token = None
+
+        while True:
+            if token:
+                kwargs['NextToken'] = token
+
+            page = getattr(self.client, self.operation)(**kwargs)
+            yield page
+
+            token = page.get('NextToken')
+
+            if not token:
+                return
+
+def response(status=200, **kwargs):
+    kwargs['ResponseMetadata'] = {'HTTPStatusCode': status}
+    return kwargs
+
+# DynamoDB
+
+def key_of(item):
+    # Tables are keyed by whatever key attributes the repo uses on them
+    return tuple(
+        json.dumps(item[name], sort_keys=True)
+        for name in ['key', 'timestamp', 'tag', 'instance_id'] if name in item
+    )
+
+def project(item, expression, names):
+    # Only plain (possibly nested) map paths, e.g. '#a.#b, c'
+    projected = {}
+
+    for path in expression.split(','):
+        source, target = item, projected
+        parts = [names.get(part, part) for part in path.strip().split('.')]
+
+        for i, part in enumerate(parts):
+            if part not in source:
+                break
+
+            if i == len(parts) - 1:
+                target[part] = source[part]
+            elif 'M' not in source[part]:
+                break
+            else:
+                source = source[part]['M']
+                target = target.setdefault(part, {'M': {}})['M']
+
+    return projected
+
+def attribute_value(value):
+    (kind, raw), = value.items()
+
+    if kind == 'N':
+        return float(raw)
+
+    return raw
+
+def key_condition(expression, names, values):
+    # Parses the `a = :x AND b <= :y` expressions the repo queries with
+    clauses = []
+
+    for clause in expression.split(' AND '):
+        name, operator, placeholder = clause.split()
+        clauses.append((names.get(name, name), operator, attribute_value(values[placeholder])))
+
+    def matches(item):
+        for name, operator, expected in clauses:
+            if name not in item:
+                return False
+
+            actual = attribute_value(item[name])
+
+            if not {
+                '=': actual == expected,
+                '<': actual < expected,
+                '<=': actual <= expected,
+                '>': actual > expected,
+                '>=': actual >= expected
+            }[operator]:
+                return False
+
+        return True
+
+    return matches
+
+def condition_holds(expression, item, values):
+    # Only understands the conditions the leases on `kv_cache` use
+    if expression.startswith('attribute_not_exists'):
+        return item is None or float(item['expires_at']['N']) < float(values[':now']['N'])
+
+    if expression == '#value = :lease':
+        return item is not None and item['value'] == values[':lease']
+
+    raise NotImplementedError(expression)
+
+class DynamoDB(Client):
+    service_name = 'dynamodb'
+
+    # Items returned per query page
+    page_size = 100
+
+    def get_item(self, TableName, Key, ProjectionExpression=None, ExpressionAttributeNames=None,
+                 **kwargs):
+        self.api_call('GetItem')
+
+        item = backend.table(TableName).get(key_of(Key))
+
+        if item is None:
+            return response()
+
+        if ProjectionExpression:
+            item = project(item, ProjectionExpression, ExpressionAttributeNames or {})
+
+        return response(Item=item)
+
+    def put_item(self, TableName, Item, **kwargs):
+        self.api_call('PutItem')
+
+        with backend.lock:
+            table = backend.table(TableName)
+            key = key_of(Item)
+
+            if 'ConditionExpression' in kwargs and not condition_holds(
+                kwargs['ConditionExpression'], table.get(key), kwargs.get('ExpressionAttributeValues', {})
+            ):
+                raise ConditionalCheckFailedException()
+
+            table[key] = Item
+
+        return response()
+
+    def delete_item(self, TableName, Key, **kwargs):
+        self.api_call('DeleteItem')
+
+        with backend.lock:
+            table = backend.table(TableName)
+            key = key_of(Key)
+
+            if 'ConditionExpression' in kwargs and not condition_holds(
+                kwargs['ConditionExpression'], table.get(key), kwargs.get('ExpressionAttributeValues', {})
+            ):
+                raise ConditionalCheckFailedException()
+
+            table.pop(key, None)
+
+        return response()
+
+    def batch_get_item(self, RequestItems):
+        self.api_call('BatchGetItem')
+
+        responses = {}
+
+        for table_name, request in RequestItems.items():
+            table = backend.table(table_name)
+            responses[table_name] = [
+                table[key_of(key)] for key in request['Keys']
+                if key_of(key) in table
+            ]
+
+        return response(Responses=responses, UnprocessedKeys={})
+
+    def batch_write_item(self, RequestItems):
+        self.api_call('BatchWriteItem')
+
+        with backend.lock:
+            for table_name, requests in RequestItems.items():
+                table = backend.table(table_name)
+
+                for request in requests:
+                    if 'PutRequest' in request:
+                        item = request['PutRequest']['Item']
+                        table[key_of(item)] = item
+                    else:
+                        table.pop(key_of(request['DeleteRequest']['Key']), None)
+
+        return response(UnprocessedItems={})
+
+    def query(self, TableName, KeyConditionExpression, **kwargs):
+        self.api_call('Query')
+
+        matches = key_condition(
+            KeyConditionExpression,
+            kwargs.get('ExpressionAttributeNames', {}),
+            kwargs.get('ExpressionAttributeValues', {})
+        )
+
+        with backend.lock:
+            items = sorted(
+                (key, item) for key, item in backend.table(TableName).items()
+                if matches(item)
+            )
+
+        start = kwargs.get('ExclusiveStartKey')
+        if start:
+            items = [(key, item) for key, item in items if key > tuple(start)]
+
+        page = items[:kwargs.get('Limit', self.page_size)]
+        resp = response(Items=[item for key, item in page], Count=len(page))
+
+        if len(items) > len(page):
+            resp['LastEvaluatedKey'] = list(page[-1][0])
+
+        return resp
+
+# EC2
+
+spot_azs = ['us-east-1{}'.format(letter) for letter in 'abcdef']
+
+def instance_filter(filters):
+    def matches(instance):
+        for data in filters:
+            name, values = data['Name'], data['Values']
+
+            if name == 'instance-id':
+                actual = [instance['InstanceId']]
+            elif name == 'instance-state-code':
+                actual = [str(instance['State']['Code'])]
+            elif name == 'tag-key':
+                actual = [tag['Key'] for tag in instance['Tags']]
+            elif name.startswith('tag:'):
+                actual = [tag['Value'] for tag in instance['Tags'] if tag['Key'] == name[4:]]
+            else:
+                raise NotImplementedError(name)
+
+            if not set(actual) & set(values):
+                return False
+
+        return True
+
+    return matches
+
+class EC2(Client):
+    service_name = 'ec2'
+
+    # Instances returned per describe_instances page
+    page_size = 1000
+
+    def describe_instances(self, Filters=None, InstanceIds=None, NextToken=None, MaxResults=None):
+        self.api_call('DescribeInstances')
+
+        matches = instance_filter(Filters or [])
+
+        with backend.lock:
+            instances = [
+                instance for instance_id, instance in sorted(backend.instances.items())
+                if matches(instance) and (not InstanceIds or instance_id in InstanceIds)
+            ]
+
+        start = int(NextToken or 0)
+        end = start + (MaxResults or self.page_size)
+
+        resp = response(Reservations=[
+            {'Instances': [instance]} for instance in instances[start:end]
+        ])
+
+        if end < len(instances):
+            resp['NextToken'] = str(end)
+
+        return resp
+
+    def terminate_instances(self, InstanceIds):
+        self.api_call('TerminateInstances')
+
+        with backend.lock:
+            for instance_id in InstanceIds:
+                if instance_id not in backend.instances:
+                    raise ClientError('InvalidInstanceID.NotFound', instance_id)
+
+            for instance_id in InstanceIds:
+                backend.instances[instance_id]['State'] = {'Code': 48, 'Name': 'terminated'}
+
+        return response(TerminatingInstances=[{'InstanceId': i} for i in InstanceIds])
+
+    def describe_spot_instance_requests(self, SpotInstanceRequestIds=None, Filters=None, NextToken=None):
+        self.api_call('DescribeSpotInstanceRequests')
+
+        def matches(request):
+            for data in Filters or []:
+                name, values = data['Name'], data['Values']
+
+                if name == 'state':
+                    actual = [request['State']]
+                elif name.startswith('tag:'):
+                    actual = [tag['Value'] for tag in request.get('Tags', []) if tag['Key'] == name[4:]]
+                else:
+                    raise NotImplementedError(name)
+
+                if not set(actual) & set(values):
+                    return False
+
+            return True
+
+        with backend.lock:
+            requests = [
+                request for request_id, request in sorted(backend.spot_requests.items())
+                if matches(request) and (not SpotInstanceRequestIds or request_id in SpotInstanceRequestIds)
+            ]
+
+        return response(SpotInstanceRequests=requests)
+
+    def create_tags(self, Resources, Tags):
+        self.api_call('CreateTags')
+
+        with backend.lock:
+            for resource in Resources:
+                if resource not in backend.instances:
+                    continue
+
+                tags = {tag['Key']: tag['Value'] for tag in backend.instances[resource]['Tags']}
+                tags.update({tag['Key']: tag['Value'] for tag in Tags})
+
+                backend.instances[resource]['Tags'] = [
+                    {'Key': key, 'Value': value} for key, value in sorted(tags.items())
+                ]
+
+        return response()
+
+    def describe_images(self, Owners=None, Filters=None, **kwargs):
+        self.api_call('DescribeImages')
+
+        # An older and a newer AMI per role
+        images = []
+
+        for role in ['helix', 'utils']:
+            for version in range(2):
+                images.append({
+                    'ImageId': 'ami-{}{}'.format(role, version),
+                    'CreationDate': '2018-0{}-01T00:00:00.000Z'.format(version + 1),
+                    'RootDeviceName': '/dev/sda1',
+                    'BlockDeviceMappings': [
+                        {'DeviceName': '/dev/sda1', 'Ebs': {'SnapshotId': 'snap-{}{}'.format(role, version)}}
+                    ],
+                    'Tags': [{'Key': 'jenkins_slave_role', 'Value': role}]
+                })
+
+        return response(Images=images)
+
+    def describe_subnets(self, Filters=None, **kwargs):
+        self.api_call('DescribeSubnets')
+
+        return response(Subnets=[
+            {
+                'SubnetId': 'subnet-{}'.format(az[-1]),
+                'AvailabilityZone': az,
+                'AvailableIpAddressCount': 250
+            }
+            for az in spot_azs
+        ])
+
+    def describe_spot_price_history(self, InstanceTypes, AvailabilityZone=None,
+                                    StartTime=None, MaxResults=1000, NextToken=None, **kwargs):
+        self.api_call('DescribeSpotPriceHistory')
+
+        history = []
+        now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+        azs = [AvailabilityZone] if AvailabilityZone else spot_azs
+
+        # A point per hour over the last day, newest first, like AWS does
+        for hours in range(24):
+            timestamp = now - timedelta(hours=hours)
+
+            if StartTime and timestamp < StartTime:
+                break
+
+            for instance_type in InstanceTypes:
+                for i, az in enumerate(azs):
+                    history.append({
+                        'AvailabilityZone': az,
+                        'InstanceType': instance_type,
+                        'ProductDescription': 'Linux/UNIX',
+                        'SpotPrice': '{:.6f}'.format(0.03 + 0.001 * ((hours + i) % 5)),
+                        'Timestamp': timestamp
+                    })
+
+        start = int(NextToken or 0)
+        end = start + MaxResults
+
+        resp = response(SpotPriceHistory=history[start:end])
+
+        if end < len(history):
+            resp['NextToken'] = str(end)
+
+        return resp
+
+# Lambda
+
+class Lambda(Client):
+    service_name = 'lambda'
+
+    def get_function(self, FunctionName):
+        self.api_call('GetFunction')
+
+        if FunctionName not in backend.functions:
+            raise ResourceNotFoundException(FunctionName)
+
+        return response(Configuration=backend.functions[FunctionName])
+
+    def create_function(self, FunctionName, **kwargs):
+        self.api_call('CreateFunction')
+
+        with backend.lock:
+            backend.functions[FunctionName] = dict(kwargs, FunctionName=FunctionName)
+
+        return response(201, FunctionName=FunctionName)
+
+    def get_waiter(self, name):
+        # Updates are instant here; waiting is a single status check
+        return types.SimpleNamespace(
+            wait=lambda **kwargs: self.api_call('GetFunctionConfiguration')
+        )
+
+    def update_function_code(self, FunctionName, **kwargs):
+        self.api_call('UpdateFunctionCode')
+
+        with backend.lock:
+            backend.functions[FunctionName].update(kwargs)
+
+        return response(FunctionName=FunctionName)
+
+    def update_function_configuration(self, FunctionName, **kwargs):
+        self.api_call('UpdateFunctionConfiguration')
+
+        with backend.lock:
+            backend.functions[FunctionName].update(kwargs)
+
+        return response(FunctionName=FunctionName)
+
+    def publish_layer_version(self, LayerName, **kwargs):
+        self.api_call('PublishLayerVersion')
+
+        with backend.lock:
+            versions = backend.layers.setdefault(LayerName, [])
+            versions.append(kwargs)
+            version = len(versions)
+
+        arn = 'arn:aws:lambda:us-east-1:000000000000:layer:{}'.format(LayerName)
+
+        return response(201, LayerArn=arn, LayerVersionArn='{}:{}'.format(arn, version), Version=version)
+
+    def invoke(self, FunctionName, Payload=None, InvocationType='RequestResponse', **kwargs):
+        self.api_call('Invoke')
+
+        result = None
+        extra = {}
+
+        handler = backend.invoke_handlers.get(FunctionName)
+
+        # Asynchronous invokes are fire and forget
+        if handler and InvocationType == 'RequestResponse':
+            # Like Lambda, handler errors come back as the payload
+            try:
+                result = handler(json.loads(Payload or 'null'))
+            except Exception as e:
+                result = {'errorMessage': str(e), 'errorType': type(e).__name__}
+                extra['FunctionError'] = 'Unhandled'
+
+        return response(
+            StatusCode=200,
+            Payload=io.BytesIO(json.dumps(result).encode('utf-8')),
+            **extra
+        )
+
+# KMS, S3
+
+class KMS(Client):
+    service_name = 'kms'
+
+    def decrypt(self, CiphertextBlob, **kwargs):
+        self.api_call('Decrypt')
+        return response(Plaintext=b'plaintext-' + CiphertextBlob)
+
+class S3(Client):
+    service_name = 's3'
+
+    def head_object(self, Bucket, Key):
+        self.api_call('HeadObject')
+
+        if (Bucket, Key) not in backend.objects:
+            raise ClientError('404', Key)
+
+        return response(ContentLength=backend.objects[(Bucket, Key)])
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        self.api_call('PutObject')
+
+        with open(Filename, 'rb') as source:
+            size = len(source.read())
+
+        with backend.lock:
+            backend.objects[(Bucket, Key)] = size
+
+clients = {
+    'dynamodb': DynamoDB,
+    'ec2': EC2,
+    'lambda': Lambda,
+    'kms': KMS,
+    's3': S3
+}
+
+def client(service_name, **kwargs):
+    # Building a real client takes a while too
+    time.sleep(backend.client_latency)
+
+    return clients[service_name](**kwargs)
+
+# CloudFlare
+
+class CloudFlareDNSRecords(object):
+    def get(self, zone_id, params=None):
+        backend.call('cloudflare', 'GetDNSRecords')
+
+        return [
+            dict(record) for record in backend.dns_records.values()
+            if record['name'] == params['name'] and record['type'] == params.get('type', 'A')
+        ]
+
+    def put(self, zone_id, record_id, data=None):
+        backend.call('cloudflare', 'PutDNSRecord')
+
+        with backend.lock:
+            if record_id not in backend.dns_records:
+                raise CloudFlareAPIError(81044, 'Record does not exist')
+
+            backend.dns_records[record_id].update(data)
+
+        return dict(backend.dns_records[record_id])
+
+class CloudFlareZones(object):
+    dns_records = CloudFlareDNSRecords()
+
+    def get(self, params=None):
+        backend.call('cloudflare', 'GetZones')
+        return [{'id': 'zone-bench', 'name': params['name']}]
+
+class CloudFlareClient(object):
+    def __init__(self, **kwargs):
+        self.zones = CloudFlareZones()
+
+def install(latency=0.0, service_latency=None, client_latency=0.0, rate_limits=None):
+    """Put the stand-ins in place of the real modules, returning the backend"""
+    backend.latency = latency
+    backend.service_latency = service_latency or {}
+    backend.client_latency = client_latency
+    backend.rate_limits = rate_limits or {}
+
+    def module(name, **attributes):
+        mod = types.ModuleType(name)
+        mod.__dict__.update(attributes)
+        sys.modules[name] = mod
+        return mod
+
+    module('boto3', client=client)
+    module('botocore')
+    module('botocore.config', Config=lambda **kwargs: kwargs)
+    module('botocore.exceptions', ClientError=ClientError, WaiterError=WaiterError)
+
+    cloudflare = module('CloudFlare', CloudFlare=CloudFlareClient)
+    cloudflare.exceptions = module('CloudFlare.exceptions', CloudFlareAPIError=CloudFlareAPIError)
+
+    return backend
@@ -0,0 +1,57 @@
+import time
+import lambda_runtime
+
+# Batch reads and writes of DynamoDB items, split into as many requests as
+# DynamoDB's limits take. Whatever DynamoDB hands back unprocessed (e.g. when
+# throttled) is retried on its own, backing off exponentially in between.
+
+dynamo_client = lambda_runtime.client('dynamodb')
+
+# DynamoDB limits per batch request
+batch_get_limit = 100
+batch_write_limit = 25
+
+max_attempts = 5
+
+def get_items(table, keys):
+    """Fetch the items under `keys` (DynamoDB keys), returning the ones found"""
+    items = []
+
+    for i in range(0, len(keys), batch_get_limit):
+        request = {table: {'Keys': keys[i:i + batch_get_limit]}}
+
+        for attempt in attempts():
+            resp = dynamo_client.batch_get_item(RequestItems=request)
+            items += resp['Responses'].get(table, [])
+
+            request = resp.get('UnprocessedKeys')
+
+            if not request:
+                break
+        else:
+            raise Exception('Unable to read from {}'.format(table))
+
+    return items
+
+def write_items(table, requests):
+    # Takes `PutRequest`s and `DeleteRequest`s, as `batch_write_item`
+    for i in range(0, len(requests), batch_write_limit):
+        request = {table: requests[i:i + batch_write_limit]}
+
+        for attempt in attempts():
+            request = dynamo_client.batch_write_item(
+                RequestItems=request
+            ).get('UnprocessedItems')
+
+            if not request:
+                break
+        else:
+            raise Exception('Unable to write to {}'.format(table))
+
+def attempts():
+    # Yields once per attempt, backing off exponentially in between
+    for attempt in range(max_attempts):
+        if attempt:
+            time.sleep(0.05 * 2 ** attempt)
+
+        yield attempt
@@ -0,0 +1,108 @@
+import math
+
+# Conversion between Python values and DynamoDB's attribute values (as used by
+# the low level client)
+#
+# dict <-> M, list/tuple <-> L, str <-> S, bytes <-> B, bool <-> BOOL,
+# None <-> NULL, int/float <-> N and sets <-> SS/NS/BS. Numbers come back as
+# ints unless they have a fraction or exponent.
+
+def encode_item(values):
+    """Turn a dict into a DynamoDB item (e.g. for `put_item`)"""
+    return {key: encode(value) for key, value in values.items()}
+
+def decode_item(item):
+    """Turn a DynamoDB item (e.g. from `get_item`) back into a dict"""
+    return {key: decode(value) for key, value in item.items()}
+
+def encode(value):
+    encoder = encoders.get(type(value))
+
+    # Subclasses (e.g. OrderedDict) go the slow way
+    if encoder is None:
+        for kind, kind_encoder in encoder_fallbacks:
+            if isinstance(value, kind):
+                encoder = kind_encoder
+                break
+        else:
+            raise TypeError('Unable to encode {} for DynamoDB'.format(type(value).__name__))
+
+    return encoder(value)
+
+def decode(value):
+    (kind, raw), = value.items()
+
+    return decoders[kind](raw)
+
+def encode_number(value):
+    if isinstance(value, float):
+        if math.isnan(value) or math.isinf(value):
+            raise ValueError('DynamoDB has no {} numbers'.format(value))
+
+        # Shortest string that reads back as the same float
+        return repr(value)
+
+    return str(value)
+
+def encode_set(value):
+    if not value:
+        raise ValueError('DynamoDB has no empty sets')
+
+    if all(isinstance(v, str) for v in value):
+        return {'SS': sorted(value)}
+
+    if all(isinstance(v, bytes) for v in value):
+        return {'BS': sorted(value)}
+
+    if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in value):
+        return {'NS': [encode_number(v) for v in sorted(value)]}
+
+    raise TypeError('DynamoDB sets hold either strings, bytes or numbers')
+
+def decode_number(raw):
+    if '.' in raw or 'e' in raw or 'E' in raw:
+        return float(raw)
+
+    return int(raw)
+
+encoders = {
+    dict: lambda value: {'M': {k: encode(v) for k, v in value.items()}},
+    list: lambda value: {'L': [encode(v) for v in value]},
+    tuple: lambda value: {'L': [encode(v) for v in value]},
+    str: lambda value: {'S': value},
+    bytes: lambda value: {'B': value},
+    bytearray: lambda value: {'B': bytes(value)},
+    bool: lambda value: {'BOOL': value},
+    type(None): lambda value: {'NULL': True},
+    int: lambda value: {'N': encode_number(value)},
+    float: lambda value: {'N': encode_number(value)},
+    set: encode_set,
+    frozenset: encode_set
+}
+
+# bool before int, since bools are ints too
+encoder_fallbacks = [
+    (dict, encoders[dict]),
+    (list, encoders[list]),
+    (tuple, encoders[tuple]),
+    (str, encoders[str]),
+    (bytes, encoders[bytes]),
+    (bool, encoders[bool]),
+    (int, encoders[int]),
+    (float, encoders[float]),
+    (frozenset, encode_set),
+    (set, encode_set)
+]
+
+decoders = {
+    'M': lambda raw: {k: decode(v) for k, v in raw.items()},
+    'L': lambda raw: [decode(v) for v in raw],
+    'S': lambda raw: raw,
+    'B': lambda raw: raw,
+    'BOOL': lambda raw: raw,
+    'NULL': lambda raw: None,
+    'N': decode_number,
+    'SS': set,
+    'BS': set,
+    'NS': lambda raw: set(decode_number(v) for v in raw)
+}
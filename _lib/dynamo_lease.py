@@ -0,0 +1,57 @@
+import time
+import uuid
+import lambda_runtime
+
+# Leases on `kv_cache`, so only one caller at a time does something
+
+dynamo_client = lambda_runtime.client('dynamodb')
+
+kv_cache_table = 'kv_cache'
+
+def acquire_lease(key, duration):
+    """Try to take the lease stored under `key` for `duration` seconds.
+
+    Returns the lease id if taken, or None if somebody else holds it. The
+    lease is a conditional write, which only succeeds if nobody holds the
+    lease or if it has expired (e.g. its holder crashed).
+    """
+    lease = str(uuid.uuid4())
+    now = time.time()
+
+    try:
+        dynamo_client.put_item(
+            TableName=kv_cache_table,
+            Item={
+                'key': {'S': key},
+                'value': {'S': lease},
+                'expires_at': {'N': str(now + duration)}
+            },
+            ConditionExpression='attribute_not_exists(#key) OR expires_at < :now',
+            ExpressionAttributeNames={'#key': 'key'},
+            ExpressionAttributeValues={':now': {'N': str(now)}}
+        )
+    except dynamo_client.exceptions.ConditionalCheckFailedException:
+        return None
+
+    return lease
+
+def release_lease(key, lease):
+    try:
+        dynamo_client.delete_item(
+            TableName=kv_cache_table,
+            Key={'key': {'S': key}},
+            ConditionExpression='#value = :lease',
+            ExpressionAttributeNames={'#value': 'value'},
+            ExpressionAttributeValues={':lease': {'S': lease}}
+        )
+
+    # Our lease expired and somebody else took over; leave theirs alone
+    except dynamo_client.exceptions.ConditionalCheckFailedException:
+        pass
+
+def clear_lease(key):
+    # Drop the lease no matter who holds it
+    dynamo_client.delete_item(
+        TableName=kv_cache_table,
+        Key={'key': {'S': key}}
+    )
@@ -0,0 +1,88 @@
+import json
+import threading
+from base64 import b64decode
+import metrics
+import rate_control
+
+# AWS clients and secrets of a function
+#
+# Importing boto3 and building clients is a good chunk of a cold start, and most
+# invocations only need some of a function's clients. So clients are only
+# created when first used, and then kept (along with decrypted secrets) for as
+# long as the container lives.
+
+default_region = 'us-east-1'
+
+# Applied to every client, unless overridden by the client itself
+default_config = {
+    'connect_timeout': 5,
+    'read_timeout': 30,
+    'retries': {'max_attempts': 4},
+    'max_pool_connections': 20
+}
+
+clients = {}
+clients_lock = threading.Lock()
+
+secrets = {}
+secrets_lock = threading.Lock()
+
+class LazyClient(object):
+    """Stand-in for a boto3 client, which is only created on first use"""
+
+    def __init__(self, service_name, region_name, config):
+        self.service_name = service_name
+        self.region_name = region_name
+        self.config = config
+        self.client = None
+
+    def __getattr__(self, name):
+        # Only called for attributes the proxy itself doesn't have
+        return getattr(self.get_client(), name)
+
+    def get_client(self):
+        if self.client is None:
+            self.client = create_client(self.service_name, self.region_name, self.config)
+
+        return self.client
+
+def client(service_name, region_name=default_region, **config):
+    """Return a lazy client for `service_name`.
+
+    `config` overrides `default_config` (see botocore's `Config`). Lazy clients
+    with the same service, region and config share a single boto3 client, and
+    with it a connection pool. A `region_name` of None means the region Lambda
+    runs on.
+    """
+    return LazyClient(service_name, region_name, config)
+
+def create_client(service_name, region_name, config):
+    key = (service_name, region_name, json.dumps(config, sort_keys=True))
+
+    # Creating clients from boto3's default session isn't thread safe
+    with clients_lock:
+        if key not in clients:
+            import boto3
+            from botocore.config import Config
+
+            options = dict(default_config)
+            options.update(config)
+
+            clients[key] = rate_control.install(metrics.instrument(boto3.client(
+                service_name,
+                region_name=region_name,
+                config=Config(**options)
+            )))
+
+        return clients[key]
+
+kms_client = client('kms', region_name=None)
+
+def decrypt(ciphertext):
+    """Decrypt a base64 encoded KMS ciphertext, once per container"""
+    with secrets_lock:
+        if ciphertext not in secrets:
+            resp = kms_client.decrypt(CiphertextBlob=b64decode(ciphertext))
+            secrets[ciphertext] = resp['Plaintext']
+
+        return secrets[ciphertext]
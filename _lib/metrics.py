@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import functools
+import threading
+
+# Timings of outbound API calls and of the major phases of each function, and
+# throttled API calls, emitted as JSON log lines (`{"metric": ...}`) along with
+# a summary per invocation. Also used by deploy.py itself.
+#
+# Off unless LAMBDA_METRICS is set, in which case nothing but a flag check is
+# left on the way of calls and phases.
+
+enabled = os.environ.get('LAMBDA_METRICS', '').lower() in ['1', 'true', 'yes']
+
+stats = {'calls': {}, 'phases': {}, 'throttles': {}}
+stats_lock = threading.Lock()
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+null_timer = NullTimer()
+
+class Timer(object):
+    def __init__(self, kind, name, labels=None):
+        self.kind = kind
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        error = exc_type.__name__ if exc_type else None
+        record(self.kind, self.name, time.perf_counter() - self.start, error, self.labels)
+        return False
+
+def phase(name, **labels):
+    """Time a block of work, e.g. `with metrics.phase('packaging'):`
+
+    `labels` are added to its log line (but not to the summary).
+    """
+    if not enabled:
+        return null_timer
+
+    return Timer('phase', name, labels)
+
+def call(name):
+    # Time a call made without boto3 (AWS calls are timed by `instrument()`)
+    if not enabled:
+        return null_timer
+
+    return Timer('call', name)
+
+def record(kind, name, duration, error=None, labels=None):
+    duration_ms = round(duration * 1000, 3)
+
+    metric = dict(labels or {})
+    metric.update({
+        'metric': kind,
+        'name': name,
+        'duration_ms': duration_ms,
+        'error': error
+    })
+
+    emit(metric)
+
+    with stats_lock:
+        entry = stats[kind + 's'].setdefault(name, {
+            'count': 0, 'errors': 0, 'total_ms': 0, 'max_ms': 0
+        })
+
+        entry['count'] += 1
+        entry['errors'] += 1 if error else 0
+        entry['total_ms'] = round(entry['total_ms'] + duration_ms, 3)
+        entry['max_ms'] = max(entry['max_ms'], duration_ms)
+
+def throttled(name, attempt):
+    # Count an API call attempt AWS throttled (see rate_control.py)
+    if not enabled:
+        return
+
+    emit({'metric': 'throttle', 'name': name, 'attempt': attempt})
+
+    with stats_lock:
+        stats['throttles'][name] = stats['throttles'].get(name, 0) + 1
+
+def emit(metric):
+    print(json.dumps(metric, sort_keys=True))
+
+def instrument(client):
+    """Time every API call of a boto3 client, through botocore's events"""
+    if not enabled:
+        return client
+
+    events = client.meta.events
+
+    events.register('before-call.*.*', before_call)
+    events.register('after-call.*.*', after_call)
+    events.register('after-call-error.*.*', after_call_error)
+
+    return client
+
+def before_call(context, **kwargs):
+    context['metrics_start'] = time.perf_counter()
+
+def after_call(event_name, context, http_response=None, parsed=None, **kwargs):
+    error = None
+
+    # Error responses (e.g. throttling) come through here too, before boto3
+    # raises them
+    if http_response is not None and http_response.status_code >= 300:
+        error = (parsed or {}).get('Error', {}).get('Code') or str(http_response.status_code)
+
+    finish_call(event_name, context, error)
+
+def after_call_error(event_name, context, exception=None, **kwargs):
+    # The request itself failed (e.g. timed out)
+    finish_call(event_name, context, type(exception).__name__)
+
+def finish_call(event_name, context, error=None):
+    start = context.pop('metrics_start', None)
+
+    if start is None:
+        return
+
+    # Events are named `after-call.<service>.<operation>`
+    name = '.'.join(event_name.split('.')[1:])
+
+    record('call', name, time.perf_counter() - start, error)
+
+def handler(function):
+    """Emit a summary of every invocation of a Lambda handler"""
+    if not enabled:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(event, context):
+        reset()
+
+        try:
+            with Timer('phase', 'invocation'):
+                return function(event, context)
+        finally:
+            summary()
+
+    return wrapper
+
+def reset():
+    with stats_lock:
+        stats['calls'] = {}
+        stats['phases'] = {}
+        stats['throttles'] = {}
+
+def summary():
+    # Totals per call, phase and throttled API since the last `reset()`
+    if not enabled:
+        return
+
+    with stats_lock:
+        emit({
+            'metric': 'summary',
+            'function': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local'),
+            'calls': stats['calls'],
+            'phases': stats['phases'],
+            'throttles': stats['throttles']
+        })
@@ -0,0 +1,210 @@
+import time
+import random
+import threading
+from collections import deque
+import metrics
+
+# Client-side rate control of AWS API calls, shared by every client of the
+# process (deploy.py's included).
+#
+# Every API (e.g. `lambda.Invoke`) gets a token bucket and a concurrency limit,
+# both unlimited until AWS first throttles it. Each throttle then halves them
+# (at most once per `decrease_interval`), and every call that isn't throttled
+# raises them back a little (AIMD), so calls settle at about the highest rate
+# AWS takes.
+# Throttled calls are retried with full jitter backoff, on top of botocore's
+# own retries, and counted in `throttles` (and by metrics, when enabled).
+
+# Error codes (or HTTP 429) AWS throttles calls with
+throttle_codes = set([
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'RequestThrottled',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'BandwidthLimitExceeded',
+    'SlowDown',
+    'EC2ThrottledException',
+    'PriorRequestNotComplete'
+])
+
+max_attempts = 8
+base_backoff = 0.1
+max_backoff = 5.0
+
+decrease_interval = 1.0
+decrease_factor = 0.5
+min_rate = 0.5
+rate_step = 1.0
+
+limiters = {}
+limiters_condition = threading.Condition()
+
+throttles = {}
+
+# The API whose slot each thread holds (calls are synchronous, so at most one)
+held = threading.local()
+
+def install(client):
+    """Rate control every API call of a boto3 client, through botocore's events"""
+    events = client.meta.events
+
+    # Sent once per attempt, and asked about retrying after each one
+    events.register('before-send.*.*', before_send)
+    events.register('needs-retry.*.*', needs_retry)
+    events.register('after-call-error.*.*', after_call_error)
+
+    return client
+
+def api_name(event_name):
+    # Events are named `<event>.<service>.<operation>`
+    return '.'.join(event_name.split('.')[1:])
+
+def new_limiter():
+    return {
+        'rate': None,
+        'tokens': 0.0,
+        'concurrency': None,
+        'in_flight': 0,
+        'updated': time.monotonic(),
+        'decreased': 0.0,
+        # When the calls of the last second went through
+        'accepted': deque()
+    }
+
+def before_send(event_name, **kwargs):
+    acquire(api_name(event_name))
+
+def acquire(name):
+    # Wait for both a token and a free slot
+    with limiters_condition:
+        limiter = limiters.setdefault(name, new_limiter())
+
+        while True:
+            now = time.monotonic()
+            refill(limiter, now)
+
+            wait = None
+
+            if limiter['concurrency'] is not None and \
+                    limiter['in_flight'] >= int(limiter['concurrency']):
+                # Woken up as soon as a slot is released
+                wait = max_backoff
+            elif limiter['rate'] is not None and limiter['tokens'] < 1:
+                wait = (1 - limiter['tokens']) / limiter['rate']
+            else:
+                break
+
+            limiters_condition.wait(wait)
+
+        if limiter['rate'] is not None:
+            limiter['tokens'] -= 1
+
+        limiter['in_flight'] += 1
+        held.name = name
+
+def refill(limiter, now):
+    if limiter['rate'] is not None:
+        # At most a second worth of calls at once
+        limiter['tokens'] = min(
+            max(limiter['rate'], 1),
+            limiter['tokens'] + (now - limiter['updated']) * limiter['rate']
+        )
+
+    limiter['updated'] = now
+
+def release(name, throttled):
+    with limiters_condition:
+        if getattr(held, 'name', None) != name:
+            return
+
+        held.name = None
+
+        limiter = limiters[name]
+        in_flight = limiter['in_flight']
+        limiter['in_flight'] -= 1
+
+        if throttled:
+            decrease(limiter, in_flight)
+        else:
+            increase(limiter)
+            accept(limiter)
+
+        limiters_condition.notify_all()
+
+def decrease(limiter, in_flight):
+    now = time.monotonic()
+
+    # A burst of throttles is a single signal
+    if now - limiter['decreased'] < decrease_interval:
+        return
+
+    limiter['decreased'] = now
+
+    # The first throttle starts from what AWS took over the last second
+    concurrency = limiter['concurrency'] or in_flight
+    limiter['concurrency'] = max(1, concurrency * decrease_factor)
+
+    rate = limiter['rate'] or max(len(limiter['accepted']), min_rate)
+    limiter['rate'] = max(min_rate, rate * decrease_factor)
+    limiter['tokens'] = min(limiter['tokens'], 0)
+
+def increase(limiter):
+    # About +1 slot and +`rate_step` calls/s per round of calls
+    if limiter['concurrency'] is not None:
+        limiter['concurrency'] += 1 / limiter['concurrency']
+
+    if limiter['rate'] is not None:
+        limiter['rate'] += rate_step / limiter['rate']
+
+def accept(limiter):
+    # Only needed until the first throttle
+    if limiter['rate'] is not None:
+        return
+
+    now = time.monotonic()
+    accepted = limiter['accepted']
+
+    accepted.append(now)
+
+    while accepted[0] < now - 1:
+        accepted.popleft()
+
+def needs_retry(event_name, attempts, response=None, caught_exception=None, **kwargs):
+    name = api_name(event_name)
+    throttled = is_throttle(response)
+
+    release(name, throttled)
+
+    if not throttled:
+        # Anything else is up to botocore
+        return None
+
+    with limiters_condition:
+        throttles[name] = throttles.get(name, 0) + 1
+
+    metrics.throttled(name, attempts)
+
+    if attempts >= max_attempts:
+        return None
+
+    # Full jitter, so throttled callers don't all come back at once
+    return random.uniform(0, min(max_backoff, base_backoff * 2 ** attempts))
+
+def after_call_error(event_name, **kwargs):
+    # The attempt failed without ever being asked about (e.g. a bug)
+    release(api_name(event_name), False)
+
+def is_throttle(response):
+    if not response:
+        return False
+
+    http_response, parsed = response
+
+    if getattr(http_response, 'status_code', None) == 429:
+        return True
+
+    return (parsed or {}).get('Error', {}).get('Code') in throttle_codes
@@ -0,0 +1,184 @@
+from datetime import datetime, timedelta, timezone
+import dynamo_lease
+import lambda_runtime
+import slave_registry
+
+# Warm pools of ready Jenkins slaves, shared by the launcher (which claims and
+# refills), and the stopper and expirator (which return slaves to the pool)
+
+ec2_client = lambda_runtime.client('ec2')
+
+# Pools per role/size: how many idle slaves to keep ready (`slaves`), and for
+# how long (in minutes) a slave may live before it's replaced, not reused, e.g.
+#
+#     'utils-small-1': {'role': 'utils', 'size': 'small-1', 'slaves': 1, 'max_age': 360}
+#
+# Claimed slaves are only retagged, so a role should only get a pool once its
+# AMI picks up the Jenkins label from the instance tags.
+pool_map = {}
+
+pool_tag = 'jenkins_slave_pool'
+state_tag = 'jenkins_slave_state'
+
+def pool_name(role, size):
+    return '{}-{}'.format(role, size)
+
+def get_pool(role, size):
+    return pool_map.get(pool_name(role, size))
+
+def member_tags(name):
+    # Extra tags of slaves launched into a pool
+    return [
+        {'Key': pool_tag, 'Value': name},
+        {'Key': state_tag, 'Value': 'idle'}
+    ]
+
+def find_idle_slaves(name):
+    # Idle slaves of the pool (booting or running), oldest first
+    pages = ec2_client.get_paginator('describe_instances').paginate(
+        Filters=[
+            {'Name': 'tag:' + pool_tag, 'Values': [name]},
+            {'Name': 'tag:' + state_tag, 'Values': ['idle']},
+            {'Name': 'instance-state-code', 'Values': ['0', '16']}
+        ]
+    )
+
+    instances = [
+        instance
+        for page in pages
+        for reservation in page['Reservations']
+        for instance in reservation['Instances']
+    ]
+
+    return sorted(instances, key=lambda instance: instance['LaunchTime'])
+
+def claim_slaves(role, size, tag, expiration_date, count):
+    """Claim up to `count` running idle slaves for `tag`, returning their ids.
+
+    Slaves are claimed with a lease on `kv_cache`, so two launches never get
+    the same slave, and then retagged as busy slaves of `tag`.
+    """
+    pool = get_pool(role, size)
+
+    if not pool:
+        return []
+
+    claimed = []
+
+    for instance in find_idle_slaves(pool_name(role, size)):
+        if len(claimed) == count:
+            break
+
+        # Still booting
+        if instance['State']['Code'] != 16:
+            continue
+
+        instance_id = instance['InstanceId']
+
+        if dynamo_lease.acquire_lease(claim_key(instance_id), pool['max_age'] * 60):
+            claimed.append(instance_id)
+
+            slave_registry.move(
+                instance_id, get_tag(instance, 'jenkins_slave_tag'), tag, expiration_date
+            )
+
+    if claimed:
+        print('Claimed {} from pool for {}-{}'.format(claimed, role, tag))
+
+        ec2_client.create_tags(
+            Resources=claimed,
+            Tags=[
+                {'Key': 'jenkins_slave_tag', 'Value': tag},
+                {'Key': 'jenkins_slave_expiration_date', 'Value': str(expiration_date)},
+                {'Key': 'Name', 'Value': 'slave-{}-{}'.format(role, tag)},
+                {'Key': state_tag, 'Value': 'busy'}
+            ]
+        )
+
+    return claimed
+
+def release_slaves(instances):
+    """Return healthy busy slaves to their pool, as long as it has room.
+
+    Takes instances as described by `describe_instances`, and returns the
+    ones that could not be returned, which are meant to be terminated.
+    """
+    now = datetime.now(timezone.utc)
+
+    idle_counts = {}
+    rejected = []
+
+    for data in instances:
+        tags = {tag['Key']: tag['Value'] for tag in data.get('Tags', [])}
+
+        name = tags.get(pool_tag)
+        pool = pool_map.get(name)
+
+        # Not a pool slave, already idle or no longer running
+        if not pool or tags.get(state_tag) != 'busy' or data['State']['Code'] != 16:
+            rejected.append(data)
+            continue
+
+        expiration_date = data['LaunchTime'] + timedelta(minutes=pool['max_age'])
+
+        # Too old to be reused
+        if expiration_date <= now:
+            rejected.append(data)
+            continue
+
+        if name not in idle_counts:
+            idle_counts[name] = len(find_idle_slaves(name))
+
+        # Pool is full
+        if idle_counts[name] >= pool['slaves']:
+            rejected.append(data)
+            continue
+
+        instance_id = data['InstanceId']
+
+        print('Returning {} to pool {}'.format(instance_id, name))
+
+        ec2_client.create_tags(
+            Resources=[instance_id],
+            Tags=[
+                {'Key': 'jenkins_slave_tag', 'Value': 'pool-{}'.format(name)},
+                {
+                    'Key': 'jenkins_slave_expiration_date',
+                    'Value': expiration_date.strftime('%Y-%m-%d %H:%M:%S.%f')
+                },
+                {'Key': 'Name', 'Value': 'slave-{}-pool'.format(pool['role'])},
+                {'Key': state_tag, 'Value': 'idle'}
+            ]
+        )
+
+        dynamo_lease.clear_lease(claim_key(instance_id))
+
+        slave_registry.move(
+            instance_id,
+            tags.get('jenkins_slave_tag'),
+            'pool-{}'.format(name),
+            expiration_date
+        )
+
+        idle_counts[name] += 1
+
+    return rejected
+
+def forget_slaves(instances):
+    """Drop the claim lease of the pool slaves among terminated `instances`.
+
+    Leases are otherwise only cleared when a slave goes back to its pool.
+    """
+    for data in instances:
+        if get_tag(data, pool_tag):
+            dynamo_lease.clear_lease(claim_key(data['InstanceId']))
+
+def get_tag(instance, key):
+    for tag in instance.get('Tags', []):
+        if tag['Key'] == key:
+            return tag['Value']
+
+    return None
+
+def claim_key(instance_id):
+    return 'slave_pool#claim#{}'.format(instance_id)
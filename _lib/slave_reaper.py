@@ -0,0 +1,91 @@
+import lambda_runtime
+import slave_pool
+
+# Finds and terminates Jenkins slaves in bulk, shared by the stopper and the
+# expirator
+
+ec2_client = lambda_runtime.client('ec2')
+
+# Instances per `terminate_instances` call, and values per filter
+terminate_batch_size = 500
+filter_batch_size = 200
+
+def find_instances(filters=None, instance_ids=None):
+    """Every pending or running instance matching the filters (or ids).
+
+    Goes through every page of results and every instance of each
+    reservation. The state is filtered on EC2's side.
+    """
+    filters = (filters or []) + [
+        {'Name': 'instance-state-code', 'Values': ['0', '16']}
+    ]
+
+    if instance_ids is None:
+        return describe_instances(filters)
+
+    instances = []
+
+    # Unlike `InstanceIds`, filtering by id doesn't fail on unknown ids
+    for i in range(0, len(instance_ids), filter_batch_size):
+        instances += describe_instances(filters + [
+            {'Name': 'instance-id', 'Values': instance_ids[i:i + filter_batch_size]}
+        ])
+
+    return instances
+
+def describe_instances(filters):
+    instances = []
+
+    for page in ec2_client.get_paginator('describe_instances').paginate(Filters=filters):
+        for reservation in page['Reservations']:
+            instances += reservation['Instances']
+
+    return instances
+
+def reap(instances):
+    """Return healthy pool slaves to their pool and terminate the rest.
+
+    Takes instances as returned by `find_instances()`. Returns how many were
+    terminated, skipped (i.e. returned to their pool) and failed, along with
+    the ids of the ones that failed.
+    """
+    rejected = slave_pool.release_slaves(instances)
+
+    report, failed = terminate([data['InstanceId'] for data in rejected])
+    report['skipped'] = len(instances) - len(rejected)
+
+    slave_pool.forget_slaves([
+        data for data in rejected if data['InstanceId'] not in failed
+    ])
+
+    return report, failed
+
+def terminate(instance_ids):
+    # Returns the counts, and the ids that couldn't be terminated
+    report = {'terminated': 0, 'failed': 0}
+    failed = []
+
+    for i in range(0, len(instance_ids), terminate_batch_size):
+        batch = instance_ids[i:i + terminate_batch_size]
+
+        print('Terminating {}'.format(batch))
+
+        try:
+            ec2_client.terminate_instances(InstanceIds=batch)
+            report['terminated'] += len(batch)
+
+        # A single bad instance fails the whole batch; find out which one
+        except ec2_client.exceptions.ClientError as e:
+            if len(batch) == 1:
+                print('Unable to terminate {}: {}'.format(batch[0], e))
+                report['failed'] += 1
+                failed += batch
+                continue
+
+            for instance_id in batch:
+                batch_report, batch_failed = terminate([instance_id])
+                report['terminated'] += batch_report['terminated']
+                report['failed'] += batch_report['failed']
+                failed += batch_failed
+
+    return report, failed
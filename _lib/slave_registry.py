@@ -0,0 +1,94 @@
+import calendar
+import dynamo_batch
+import lambda_runtime
+
+# Registry of launched Jenkins slaves, so the stopper and expirator can find
+# them with key lookups instead of scanning every instance. Entries are keyed
+# by slave tag and instance id, and `expiration_index` sorts them all by
+# expiration date (they share a single `shard` for that).
+
+dynamo_client = lambda_runtime.client('dynamodb')
+
+registry_table = 'jenkins_slave_registry'
+expiration_index = 'expiration_index'
+registry_shard = 'slave'
+
+def register(tag, instance_ids, expiration_date):
+    """Add (or overwrite) the entries of the instances launched for `tag`.
+
+    `expiration_date` is a naive UTC datetime, as used on the slave tags.
+    """
+    dynamo_batch.write_items(registry_table, [
+        {
+            'PutRequest': {
+                'Item': {
+                    'tag': {'S': tag},
+                    'instance_id': {'S': instance_id},
+                    'shard': {'S': registry_shard},
+                    'expiration_date': {'N': str(to_epoch(expiration_date))}
+                }
+            }
+        }
+        for instance_id in instance_ids
+    ])
+
+def unregister(entries):
+    # Takes entries as returned by `find_by_tag()` or `find_expired()`
+    dynamo_batch.write_items(registry_table, [
+        {
+            'DeleteRequest': {
+                'Key': {
+                    'tag': {'S': entry['tag']},
+                    'instance_id': {'S': entry['instance_id']}
+                }
+            }
+        }
+        for entry in entries
+    ])
+
+def move(instance_id, old_tag, new_tag, expiration_date):
+    # Re-register an instance under a new tag (e.g. claimed from a pool)
+    if old_tag:
+        unregister([{'tag': old_tag, 'instance_id': instance_id}])
+
+    register(new_tag, [instance_id], expiration_date)
+
+def find_by_tag(tag):
+    return query(
+        KeyConditionExpression='#tag = :tag',
+        ExpressionAttributeNames={'#tag': 'tag'},
+        ExpressionAttributeValues={':tag': {'S': tag}}
+    )
+
+def find_expired(now):
+    # Only reads the entries that are due, no matter how many there are
+    return query(
+        IndexName=expiration_index,
+        KeyConditionExpression='#shard = :shard AND expiration_date <= :now',
+        ExpressionAttributeNames={'#shard': 'shard'},
+        ExpressionAttributeValues={
+            ':shard': {'S': registry_shard},
+            ':now': {'N': str(to_epoch(now))}
+        }
+    )
+
+def query(**kwargs):
+    entries = []
+
+    while True:
+        resp = dynamo_client.query(TableName=registry_table, **kwargs)
+
+        for item in resp['Items']:
+            entries.append({
+                'tag': item['tag']['S'],
+                'instance_id': item['instance_id']['S'],
+                'expiration_date': int(item['expiration_date']['N'])
+            })
+
+        if 'LastEvaluatedKey' not in resp:
+            return entries
+
+        kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+def to_epoch(date):
+    return calendar.timegm(date.utctimetuple())
@@ -0,0 +1,78 @@
+import json
+from datetime import datetime
+import lambda_runtime
+import metrics
+import slave_registry
+
+# Spot requests of slaves launched asynchronously, which carry the slave tags
+# until their instances get them. Shared by the launcher (once EC2 reports a
+# request as fulfilled, or the caller polls for it) and the expirator (in case
+# neither ever happens).
+
+ec2_client = lambda_runtime.client('ec2')
+
+def complete_spot_requests(spot_request_ids):
+    """Tag the instances of fulfilled spot requests with the request's tags.
+
+    Instances are also added to the slave registry. Both are idempotent, so
+    this is safe to run more than once for the same request. Requests that
+    aren't for Jenkins slaves (fulfillment events come for every spot request
+    on the account) are left alone. Returns the spot requests, as described by
+    EC2.
+    """
+    requests = ec2_client.describe_spot_instance_requests(
+        SpotInstanceRequestIds=spot_request_ids
+    )['SpotInstanceRequests']
+
+    complete(requests)
+
+    return requests
+
+def complete_active_requests():
+    # Every slave request with a running instance; returns how many there are
+    pages = ec2_client.get_paginator('describe_spot_instance_requests').paginate(
+        Filters=[
+            {'Name': 'tag:Role', 'Values': ['JenkinsSlave']},
+            {'Name': 'state', 'Values': ['active']}
+        ]
+    )
+
+    requests = [request for page in pages for request in page['SpotInstanceRequests']]
+
+    complete(requests)
+
+    return len(requests)
+
+def complete(requests):
+    # Instances sharing the same tags (i.e. same launch) are tagged together
+    tag_groups = {}
+
+    for request in requests:
+        tags = [
+            tag for tag in request.get('Tags', [])
+            if not tag['Key'].startswith('aws:')
+        ]
+
+        if 'InstanceId' in request and is_slave_request(tags):
+            key = json.dumps(tags, sort_keys=True)
+            tag_groups.setdefault(key, []).append(request['InstanceId'])
+
+    for key, instance_ids in tag_groups.items():
+        tags = json.loads(key)
+
+        with metrics.phase('tagging'):
+            ec2_client.create_tags(Resources=instance_ids, Tags=tags)
+
+            tags = {tag['Key']: tag['Value'] for tag in tags}
+
+            slave_registry.register(
+                tags['jenkins_slave_tag'],
+                instance_ids,
+                datetime.strptime(tags['jenkins_slave_expiration_date'], '%Y-%m-%d %H:%M:%S.%f')
+            )
+
+def is_slave_request(tags):
+    tags = {tag['Key']: tag['Value'] for tag in tags}
+
+    return tags.get('Role') == 'JenkinsSlave' and 'jenkins_slave_tag' in tags \
+        and 'jenkins_slave_expiration_date' in tags
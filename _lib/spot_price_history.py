@@ -0,0 +1,156 @@
+import sys
+import math
+import zlib
+import json
+import array
+import struct
+
+# Spot price history of every instance type/AZ pair, as used by the launcher.
+#
+# Each pair keeps a pair of arrays: when its price changed (epoch seconds) and
+# what it changed to, oldest first. Spot prices are step functions, so every
+# point holds until the next one. History is kept for `window` seconds, plus
+# the point in effect when the window starts.
+
+window = 24 * 60 * 60
+
+def empty():
+    # `watermark` is where the next refresh picks up from (epoch seconds)
+    return {'watermark': None, 'series': {}}
+
+def series_key(instance, az):
+    return '{}/{}'.format(instance, az)
+
+def add_point(history, instance, az, timestamp, price):
+    """Add a price point, unless the pair already has a newer (or same) one.
+
+    Points must be added oldest first.
+    """
+    times, prices = history['series'].setdefault(
+        series_key(instance, az), (array.array('q'), array.array('d'))
+    )
+
+    if times and times[-1] >= timestamp:
+        return False
+
+    times.append(int(timestamp))
+    prices.append(price)
+
+    return True
+
+def has_series(history, instance, az):
+    return series_key(instance, az) in history['series']
+
+def trim(history, now):
+    # Drop points that stopped being in effect before the window
+    start = now - window
+
+    for times, prices in history['series'].values():
+        first = 0
+
+        while first + 1 < len(times) and times[first + 1] <= start:
+            first += 1
+
+        if first:
+            del times[:first]
+            del prices[:first]
+
+def stats(history, instance, az, now):
+    """Current price, and rolling minimum, mean and volatility of a pair.
+
+    The mean is weighted by how long each price held over the window, and
+    volatility is the (also time weighted) standard deviation over the mean.
+    Returns None for pairs without history.
+    """
+    series = history['series'].get(series_key(instance, az))
+
+    if not series or not series[0]:
+        return None
+
+    times, prices = series
+    start = now - window
+
+    total = 0
+    weighted = 0
+    weighted_squares = 0
+
+    for i, price in enumerate(prices):
+        held_from = max(times[i], start)
+        held_until = times[i + 1] if i + 1 < len(times) else now
+
+        duration = held_until - held_from
+
+        if duration <= 0:
+            continue
+
+        total += duration
+        weighted += price * duration
+        weighted_squares += price * price * duration
+
+    if not total:
+        mean = prices[-1]
+        variance = 0
+    else:
+        mean = weighted / total
+        variance = max(weighted_squares / total - mean * mean, 0)
+
+    return {
+        'price': prices[-1],
+        'min': min(prices),
+        'mean': mean,
+        'volatility': math.sqrt(variance) / mean if mean else 0
+    }
+
+def encode(history):
+    """Pack the history into compressed bytes, e.g. to store on DynamoDB.
+
+    A JSON header lists each pair and its length, followed by every pair's
+    arrays, little endian.
+    """
+    keys = sorted(history['series'])
+
+    header = json.dumps({
+        'watermark': history['watermark'],
+        'series': [[key, len(history['series'][key][0])] for key in keys]
+    }).encode('utf-8')
+
+    chunks = [struct.pack('<I', len(header)), header]
+
+    for key in keys:
+        for values in history['series'][key]:
+            chunks.append(little_endian(values).tobytes())
+
+    return zlib.compress(b''.join(chunks))
+
+def decode(data):
+    data = zlib.decompress(data)
+
+    header_size, = struct.unpack_from('<I', data)
+    header = json.loads(data[4:4 + header_size].decode('utf-8'))
+
+    history = {'watermark': header['watermark'], 'series': {}}
+    offset = 4 + header_size
+
+    for key, length in header['series']:
+        series = []
+
+        for typecode in ['q', 'd']:
+            values = array.array(typecode)
+            size = length * values.itemsize
+
+            values.frombytes(data[offset:offset + size])
+            offset += size
+
+            series.append(little_endian(values))
+
+        history['series'][key] = tuple(series)
+
+    return history
+
+def little_endian(values):
+    # Swapping is its own inverse, so this works both ways
+    if sys.byteorder == 'big':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+
+    return values
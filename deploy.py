@@ -1,26 +1,63 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from hashlib import md5, sha256
 import subprocess
+import functools
+import argparse
+import tempfile
+import calendar
+import fnmatch
 import base64
+import zipfile
 import shutil
 import json
 import sys
 import os
 import boto3
 
-lambda_client = boto3.client('lambda', region_name='us-east-1')
+# Modules shared with the functions
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '_lib'))
+
+import metrics
+import rate_control
+
+lambda_client = rate_control.install(metrics.instrument(
+    boto3.client('lambda', region_name='us-east-1')
+))
 lambda_meta_deployer = 'lambdaMetaDeployer'
 
-with_error = False
+# What `invoke_deployer()` fails with when the deployer is too old to take
+# anything but the legacy `zip_file` payload
+outdated_deployer_error = 'deploy_outdated_deployer'
+
+# Packages are handed to `lambdaMetaDeployer` through S3 rather than inside
+# the invoke payload. The endpoint may point to a local S3 stand-in.
+s3_client = rate_control.install(metrics.instrument(boto3.client(
+    's3',
+    region_name='us-east-1',
+    endpoint_url=os.environ.get('DEPLOY_S3_ENDPOINT')
+)))
+artifact_bucket = os.environ.get('DEPLOY_ARTIFACT_BUCKET', 'lambda-store-artifacts')
+
+# Everything under `_cache/` survives `bootstrap()` and is reused across runs:
+# - the hash of every function as of its last successful deploy;
+# - installed dependency trees, keyed by the hash of their requirements;
+# - the wheels they were installed from, so installs also work offline.
+manifest_path = '_cache/manifest.json'
+dependencies_cache_dir = '_cache/dependencies'
+wheels_cache_dir = '_cache/wheels'
 
 def bootstrap():
     # Cleanup and prepare packaging folder
     shutil.rmtree('_packages/', ignore_errors=True)
     os.makedirs('_packages')
 
-    shutil.rmtree('_dependencies/', ignore_errors=True)
-    os.makedirs('_dependencies', exist_ok=True)
+    os.makedirs(dependencies_cache_dir, exist_ok=True)
+    os.makedirs(wheels_cache_dir, exist_ok=True)
 
 def scan_folders():
-    # Traverse the folder, detect functions and deploy each one individually
+    # Traverse the folder and detect functions
+    functions = []
+
     for root, dirs, files in os.walk('.', topdown=False):
         if root.startswith('./.'):
             continue
@@ -33,71 +70,794 @@ def scan_folders():
 
         # It's-a me, function!
         if 'config.json' in files:
-            function_name = root[2:]
+            functions.append(root[2:])
+
+    return sorted(functions)
+
+# Timestamp stamped on every zip entry (the earliest one zip supports), so
+# that packages only change when their contents do
+zip_date_time = (1980, 1, 1, 0, 0, 0)
+
+# Lambda unpacks files with the zip entry's timestamp as their mtime, which is
+# what shipped bytecode is checked against
+zip_epoch = calendar.timegm(zip_date_time)
+
+# What functions run on, unless their config has a `runtime` (must match
+# `lambdaMetaDeployer`)
+default_runtime = 'python3.6'
+
+# Where Lambda unpacks functions and layers, which is what tracebacks show
+task_root = '/var/task'
+layer_root = '/opt'
+
+# Dependency files left out of layers: those whose name, or the name of any
+# folder they're in, matches. Configs may add their own with `prune`, and
+# bring files back with `keep` (patterns on the whole path, e.g. for packages
+# that read their own `*.dist-info`). Bytecode is never taken from
+# dependencies, since it's compiled again for the function's runtime.
+default_prune_patterns = [
+    '*.pyo',
+    '*.dist-info', '*.egg-info',
+    'tests', 'test',
+    'docs', 'doc', 'examples', '*.md', '*.rst',
+    'bin'
+]
+
+def list_files(directory, bytecode=False):
+    # Every file under `directory` that ends up in a package, in a stable order
+    paths = []
+
+    for root, dirs, files in os.walk(directory):
+        if not bytecode:
+            dirs[:] = [d for d in dirs if d != '__pycache__']
+
+        for file_name in files:
+            if bytecode or not file_name.endswith('.pyc'):
+                paths.append(os.path.join(root, file_name))
+
+    return sorted(paths)
+
+def function_hash(function_name):
+    """Content hash of a function directory.
+
+    Covers the path and contents of every file, which includes both
+    `config.json` and `requirements.txt`, as well as of every file the config
+    includes from elsewhere in the repo. Any change to either one, or to the
+    code, results in a new hash.
+    """
+    digest = sha256()
+
+    for path in list_files(function_name) + included_files(function_name):
+        digest.update(path.encode('utf-8') + b'\0')
+        hash_file(digest, path)
+        digest.update(b'\0')
+
+    return digest.hexdigest()
+
+def included_files(function_name):
+    # Files from elsewhere in the repo the function asked to be packaged with
+    try:
+        with open(function_name + '/config.json') as config_file:
+            include = json.load(config_file).get('include', [])
+
+    # Invalid configs are reported by `build()`
+    except (IOError, ValueError):
+        return []
+
+    return [path for path in sorted(include) if os.path.isfile(path)]
+
+def hash_file(digest, path):
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(65536), b''):
+            digest.update(chunk)
+
+    return digest
+
+def load_manifest():
+    try:
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+    except (IOError, ValueError):
+        return {}
+
+def save_manifest(manifest):
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+
+    # Write to a temporary file first so an interrupted run never leaves a
+    # truncated manifest behind
+    tmp_path = manifest_path + '.tmp'
+
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+    os.replace(tmp_path, manifest_path)
+
+def deploy_all(function_names, jobs, batch_size, compression_level, force=False):
+    """Build and deploy every function, returning a result per function.
+
+    Functions whose hash matches the one recorded on the manifest by the last
+    successful deploy aren't built again, unless `force` is set. The manifest
+    only knows about deploys from this workspace though, so they're still
+    probed (with the package and config hashes it recorded), and built after
+    all if something else got deployed since.
+
+    Packaging (pip + zip) is CPU/IO bound and runs on a process pool. Once
+    every package is built, a single probe asks `lambdaMetaDeployer` which
+    ones differ from what is deployed, and only those (or all of them, with
+    `force`) are uploaded (along with their dependency layer, if not there
+    yet), through a bounded thread pool, and deployed `batch_size` functions
+    per invoke.
+    """
+    results = {}
+
+    def probe(hashes):
+        stale = probe_functions(hashes)
+
+        # The deployer still takes the legacy payload; bring it up to date
+        if stale is None:
+            bootstrap_deployer(compression_level)
+            stale = probe_functions(hashes)
+
+        return list(hashes) if stale is None else stale
+
+    manifest = load_manifest()
+
+    with metrics.phase('hash'):
+        hashes = {name: function_hash(name) for name in function_names}
+
+    pending = []
+    matched = {}
+
+    for function_name in function_names:
+        entry = manifest.get(function_name)
+
+        # Entries from before the manifest recorded hashes don't match
+        if not force and isinstance(entry, dict) and entry['hash'] == hashes[function_name]:
+            matched[function_name] = (entry['zip_hash'], entry['config_hash'])
+        else:
+            pending.append(function_name)
+
+    if matched:
+        with metrics.phase('probe'):
+            drifted = probe(matched)
+
+        for function_name in matched:
+            if function_name in drifted:
+                print('{} was changed since last deploy; deploying'.format(function_name))
+                pending.append(function_name)
+            else:
+                print('{} hasn\'t changed since last deploy'.format(function_name))
+                results[function_name] = 'unchanged'
+
+    built = {}
+
+    with metrics.phase('build'), ProcessPoolExecutor(max_workers=jobs) as build_pool:
+        builds = {
+            build_pool.submit(build, function_name, compression_level): function_name
+            for function_name in pending
+        }
 
-            if 'requirements.txt' in files:
-                os.makedirs('_dependencies/{}'.format(function_name))
+        for future in as_completed(builds):
+            function_name = builds[future]
 
-            deploy(function_name)
+            try:
+                built[function_name] = future.result()
+            except Exception as e:
+                results[function_name] = 'build failed: {}'.format(e)
 
-    if with_error:
-        raise Exception('Some functions were not deployed')
+    with metrics.phase('probe'):
+        stale = probe(deployed_hashes(built)) if built else []
 
-def deploy(function_name):
+    # Forced deploys go through whatever the probe says (which still brings an
+    # outdated deployer up to date)
+    if force:
+        stale = sorted(built)
+
+    for function_name in built:
+        if function_name not in stale:
+            print('{} is already deployed'.format(function_name))
+            results[function_name] = 'unchanged'
+            manifest[function_name] = manifest_entry(hashes[function_name], built[function_name])
+
+    with ThreadPoolExecutor(max_workers=jobs) as invoke_pool:
+        uploads = {
+            invoke_pool.submit(upload_function, function_name, built[function_name]): function_name
+            for function_name in stale
+        }
+        artifacts = {}
+
+        with metrics.phase('upload'):
+            for future in as_completed(uploads):
+                function_name = uploads[future]
+
+                try:
+                    artifacts[function_name] = future.result()
+                except Exception as e:
+                    results[function_name] = 'upload failed: {}'.format(e)
+
+        # Uploaded functions are deployed a batch per invoke
+        uploaded = sorted(artifacts)
+        batches = [
+            uploaded[i:i + batch_size]
+            for i in range(0, len(uploaded), batch_size)
+        ]
+
+        # Batches run concurrently; layers they share are published up front,
+        # or each batch would publish its own version of them
+        if len(batches) > 1:
+            with metrics.phase('layers'):
+                publish_layers(uploaded, built, artifacts)
+
+        invokes = {
+            invoke_pool.submit(deploy_batch, batch, built, artifacts, force): batch
+            for batch in batches
+        }
+
+        with metrics.phase('deploy'):
+            for future in as_completed(invokes):
+                batch = invokes[future]
+
+                try:
+                    batch_results = future.result()
+                except Exception as e:
+                    batch_results = {name: 'error: {}'.format(e) for name in batch}
+
+                for function_name in batch:
+                    result = batch_results.get(function_name, 'error: missing result')
+
+                    if result.startswith('error'):
+                        results[function_name] = 'deploy failed: {}'.format(result)
+                    else:
+                        print('{} deployed ({})'.format(function_name, result))
+                        results[function_name] = 'deployed'
+                        manifest[function_name] = manifest_entry(
+                            hashes[function_name], built[function_name]
+                        )
+
+    save_manifest(manifest)
+
+    return results
+
+def build(function_name, compression_level):
+    """Package the function and its dependency layer.
+
+    Returns the function's config, package hash and layer hash (None if the
+    function has no dependencies).
+    """
     print('Packaging {}'.format(function_name))
-    
-    with open(function_name + '/config.json') as config_file:    
+
+    with open(function_name + '/config.json') as config_file:
         config = json.load(config_file)
 
     validate_config(config)
 
     print('Using config: {}'.format(config))
 
-    setup_dependencies(function_name)
+    # Runs on a worker process, so these only show up as log lines
+    with metrics.phase('dependencies', function=function_name):
+        dependencies_dir = setup_dependencies(function_name)
 
-    create_package(function_name, config)
+    with metrics.phase('packaging', function=function_name):
+        sizes = create_package(function_name, config, compression_level)
 
-    upsert_function(function_name, config)
+    print_sizes('{} package'.format(function_name), sizes)
 
-def upsert_function(function_name, config):
-    with open('_packages/{}.zip'.format(function_name), 'rb') as package:
-        contents = package.read()
-        b64_zip_str = base64.b64encode(contents).decode('utf-8')
+    package_path = '_packages/{}.zip'.format(function_name)
+    layer_hash = None
 
-        payload = {
-            'zip_file': b64_zip_str,
-            'config': config,
-            'target_function': function_name
-        }
+    if dependencies_dir:
+        with metrics.phase('layer', function=function_name):
+            sizes = create_layer(function_name, config, dependencies_dir, compression_level)
 
-        resp = lambda_client.invoke(
-            FunctionName=lambda_meta_deployer,
-            Payload=json.dumps(payload)
-        )
+        print_sizes('{} layer'.format(function_name), sizes)
 
-        if resp['ResponseMetadata']['HTTPStatusCode'] != 200:
-            print('Bad status code for {}: {}'.format(function_name, resp))
-            with_error = True
-        else:
-            print('{} deployed\n\n'.format(function_name))
+        layer_hash = hash_file(sha256(), layer_path(function_name)).hexdigest()
 
-def create_package(function_name, config):
-    # Zip application-specific stuff
-    cmd1 = 'cd {0}; zip -X -r9 ../_packages/{0}.zip *'.format(function_name)
-    subprocess.run(cmd1, check=True, shell=True)
+    return config, hash_file(sha256(), package_path).hexdigest(), layer_hash
 
-    # Add dependencies to package (if they exist)
-    if os.path.exists('_dependencies/{}/'.format(function_name)):
-        cmd2 = 'cd _dependencies/{0}; zip -X -r9 ../../_packages/{0}.zip *'.format(function_name)
-        subprocess.run(cmd2, check=True, shell=True)
+def layer_path(function_name):
+    return '_packages/{}.layer.zip'.format(function_name)
 
-    if not os.stat('_packages/{0}.zip'.format(function_name)):
+def print_sizes(name, sizes):
+    print(
+        '{}: {} files ({}) before, {} files ({}) after, {} zipped; '
+        '{} files pruned, {} compiled'.format(
+            name,
+            sizes['files_before'], format_size(sizes['bytes_before']),
+            sizes['files_after'], format_size(sizes['bytes_after']),
+            format_size(sizes['zip_bytes']),
+            sizes['pruned'], sizes['compiled']
+        )
+    )
+
+def format_size(size):
+    if size < 1024:
+        return '{} B'.format(size)
+
+    if size < 1024 * 1024:
+        return '{:.1f} KiB'.format(size / 1024)
+
+    return '{:.1f} MiB'.format(size / 1024 / 1024)
+
+def probe_functions(hashes):
+    """Return which functions differ from what is deployed.
+
+    Takes the package and config hashes of each function, as returned by
+    `deployed_hashes()`. Only those are sent, so this costs one small invoke
+    no matter how many functions there are. Should the probe fail, every
+    function is considered stale and deployed as usual. Returns None if the
+    deployer is too old to take probes (see `bootstrap_deployer()`).
+    """
+    payload = {
+        'action': 'probe',
+        'functions': [
+            {
+                'target_function': function_name,
+                'zip_hash': zip_hash,
+                'config_hash': function_config_hash
+            }
+            for function_name, (zip_hash, function_config_hash) in hashes.items()
+        ]
+    }
+
+    try:
+        return invoke_deployer(payload)['stale']
+    except Exception as e:
+        if str(e) == outdated_deployer_error:
+            return None
+
+        print('Probe failed, deploying every function: {}'.format(e))
+        return list(hashes)
+
+def bootstrap_deployer(compression_level):
+    """Deploy `lambdaMetaDeployer` through the deployer that is out there.
+
+    Deployers from before packages went through S3 only take the package
+    itself (base64) on the payload, and only ever update code. That's enough
+    for it to take every other payload, so it's then deployed again the usual
+    way, which brings its config (e.g. its timeout) up to date as well.
+    """
+    print('{} only takes legacy payloads; updating it first'.format(lambda_meta_deployer))
+
+    build_result = build(lambda_meta_deployer, compression_level)
+
+    with open('_packages/{}.zip'.format(lambda_meta_deployer), 'rb') as package:
+        zip_file = base64.b64encode(package.read()).decode('utf-8')
+
+    invoke_deployer({
+        'target_function': lambda_meta_deployer,
+        'zip_file': zip_file,
+        'config': build_result[0]
+    })
+
+    # Invokes keep going to the previous code until the update is done
+    lambda_client.get_waiter('function_updated').wait(FunctionName=lambda_meta_deployer)
+
+    built = {lambda_meta_deployer: build_result}
+    artifacts = {lambda_meta_deployer: upload_function(lambda_meta_deployer, build_result)}
+
+    # Should this fail, it's deployed again along with everything else
+    try:
+        result = deploy_batch([lambda_meta_deployer], built, artifacts)[lambda_meta_deployer]
+    except Exception as e:
+        result = 'error: {}'.format(e)
+
+    print('{} bootstrapped ({})'.format(lambda_meta_deployer, result))
+
+def deployed_hashes(built):
+    # The hashes `lambdaMetaDeployer` caches for each built function
+    return {
+        function_name: (zip_hash, config_hash(config, layer_hash))
+        for function_name, (config, zip_hash, layer_hash) in built.items()
+    }
+
+def manifest_entry(function_hash, build):
+    # What gets probed next time the function's hash matches
+    config, zip_hash, layer_hash = build
+
+    return {
+        'hash': function_hash,
+        'zip_hash': zip_hash,
+        'config_hash': config_hash(config, layer_hash)
+    }
+
+def publish_layers(function_names, built, artifacts):
+    # Should this fail, every batch publishes the layers it needs instead
+    layers = {}
+
+    for function_name in function_names:
+        layer = artifacts[function_name]['layer']
+
+        if layer and layer['sha'] not in layers:
+            layers[layer['sha']] = {
+                'target_function': function_name,
+                'layer': layer,
+                'config': built[function_name][0]
+            }
+
+    if not layers:
+        return
+
+    try:
+        invoke_deployer({'action': 'layers', 'functions': list(layers.values())})
+    except Exception as e:
+        print('Publishing layers failed: {}'.format(e))
+
+def deploy_batch(function_names, built, artifacts, force=False):
+    """Deploy several uploaded functions with a single invoke.
+
+    With `force`, functions are updated even if the deployer's cache says
+    they're deployed already. Returns the deployer's result for each function.
+    """
+    payload = {
+        'action': 'deploy',
+        'functions': [
+            {
+                'target_function': function_name,
+                'artifact': artifacts[function_name]['artifact'],
+                'layer': artifacts[function_name]['layer'],
+                'config': built[function_name][0],
+                'force': force
+            }
+            for function_name in function_names
+        ]
+    }
+
+    return invoke_deployer(payload)['results']
+
+def invoke_deployer(payload):
+    resp = lambda_client.invoke(
+        FunctionName=lambda_meta_deployer,
+        Payload=json.dumps(payload)
+    )
+
+    if resp['ResponseMetadata']['HTTPStatusCode'] != 200:
+        error('deploy', 'bad_status_code_{}'.format(
+            resp['ResponseMetadata']['HTTPStatusCode']
+        ))
+
+    response = resp['Payload'].read().decode('utf-8')
+
+    # The invoke itself succeeded but the deployer raised
+    if 'FunctionError' in resp:
+        if is_legacy_error(json.loads(response)):
+            error('deploy', 'outdated_deployer')
+
+        error('deploy', response)
+
+    return json.loads(response)
+
+def is_legacy_error(response):
+    # How deployers that only take `zip_file` payloads fail on everything else
+    return isinstance(response, dict) and response.get('errorType') == 'KeyError' \
+        and 'zip_file' in response.get('errorMessage', '')
+
+def upload_function(function_name, build):
+    # Upload the package and layer of a function built by `build()`
+    config, zip_hash, layer_hash = build
+
+    artifact = upload_artifact(
+        '_packages/{}.zip'.format(function_name),
+        '{}/{}.zip'.format(function_name, zip_hash),
+        zip_hash
+    )
+
+    layer = None
+
+    # Layers are shared by every function with the same dependencies
+    if layer_hash:
+        layer = upload_artifact(
+            layer_path(function_name),
+            'layers/{}.zip'.format(layer_hash),
+            layer_hash
+        )
+
+    return {'artifact': artifact, 'layer': layer}
+
+def upload_artifact(package_path, key, zip_hash):
+    """Upload a package to S3 and return a reference to it.
+
+    Keys are content-addressed, so a package that is already there (e.g. from
+    a previous, partially failed run) is not uploaded again.
+    """
+    try:
+        s3_client.head_object(Bucket=artifact_bucket, Key=key)
+        print('{} already uploaded'.format(key))
+    except s3_client.exceptions.ClientError:
+        # Streams the file (in parts, if large) instead of loading it whole
+        s3_client.upload_file(package_path, artifact_bucket, key)
+
+    return {
+        'bucket': artifact_bucket,
+        'key': key,
+        'sha': zip_hash
+    }
+
+def create_package(function_name, config, compression_level):
+    """Zip the function into `_packages/<function>.zip`.
+
+    Dependencies go on a layer of their own instead (see `create_layer()`).
+    Returns file counts and sizes, as `write_package()`.
+    """
+    entries = {}
+
+    # Shared files from elsewhere in the repo (i.e. `_lib` modules) go on the
+    # package root, so functions import them as top-level modules
+    for path in config.get('include', []):
+        entries[os.path.basename(path)] = path
+
+    # Application-specific stuff takes precedence over everything else
+    for path in list_files(function_name):
+        entries[os.path.relpath(path, function_name)] = path
+
+    if not entries:
         error('internal', 'error_creating_zip')
 
+    sizes = write_package(
+        entries, '_packages/{}.zip'.format(function_name),
+        config.get('runtime', default_runtime), task_root, compression_level
+    )
+    sizes['files_before'] = len(entries)
+    sizes['pruned'] = 0
+
+    return sizes
+
+def create_layer(function_name, config, dependencies_dir, compression_level):
+    """Zip the function's dependencies into a layer, on `layer_path()`.
+
+    Layers are unpacked on `/opt`, and Lambda puts `/opt/python` on the path.
+    Dependencies are pruned first (see `default_prune_patterns`).
+    """
+    prune_patterns = default_prune_patterns + config.get('prune', [])
+    keep_patterns = config.get('keep', [])
+
+    files = list_files(dependencies_dir)
+    entries = {}
+
+    for path in files:
+        arcname = os.path.relpath(path, dependencies_dir)
+
+        if not is_pruned(arcname, prune_patterns, keep_patterns):
+            entries[os.path.join('python', arcname)] = path
+
+    sizes = write_package(
+        entries, layer_path(function_name),
+        config.get('runtime', default_runtime), layer_root, compression_level
+    )
+    sizes['files_before'] = len(files)
+    sizes['bytes_before'] = sum(os.path.getsize(path) for path in files)
+    sizes['pruned'] = len(files) - len(entries)
+
+    return sizes
+
+def write_package(entries, package_path, runtime, root, compression_level):
+    """Zip `entries` (package path -> file path) into `package_path`.
+
+    Everything is staged next to the package first, to be compiled to
+    bytecode for `runtime`, which is shipped along with the sources. `root` is
+    where Lambda unpacks the package.
+
+    The archive is reproducible: entries are sorted and have their timestamp
+    and permissions normalized, so identical inputs yield a byte-identical
+    zip (and thus an identical hash on `lambdaMetaDeployer`).
+
+    Returns file counts and sizes from before and after compiling.
+    """
+    staging_dir = package_path[:-len('.zip')]
+
+    stage_files(entries, staging_dir)
+
+    sizes = {
+        'bytes_before': sum(os.path.getsize(path) for path in entries.values()),
+        'compiled': compile_bytecode(staging_dir, runtime, root)
+    }
+
+    if compression_level:
+        compression = zipfile.ZIP_DEFLATED
+    else:
+        compression = zipfile.ZIP_STORED
+
+    staged = list_files(staging_dir, bytecode=True)
+
+    with zipfile.ZipFile(package_path, 'w', compression, compresslevel=compression_level) as package:
+        for path in sorted(staged, key=lambda path: os.path.relpath(path, staging_dir)):
+            write_zip_entry(package, os.path.relpath(path, staging_dir), path)
+
+    sizes['files_after'] = len(staged)
+    sizes['bytes_after'] = sum(os.path.getsize(path) for path in staged)
+    sizes['zip_bytes'] = os.path.getsize(package_path)
+
+    shutil.rmtree(staging_dir)
+
+    return sizes
+
+def is_pruned(arcname, prune_patterns, keep_patterns):
+    for pattern in keep_patterns:
+        if fnmatch.fnmatch(arcname, pattern):
+            return False
+
+    for part in arcname.split(os.sep):
+        for pattern in prune_patterns:
+            if fnmatch.fnmatch(part, pattern):
+                return True
+
+    return False
+
+def stage_files(entries, staging_dir):
+    # Copy the files where they'll be packaged from, stamped with the time
+    # they'll have once unpacked by Lambda
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+    for arcname, path in entries.items():
+        target = os.path.join(staging_dir, arcname)
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy(path, target)
+        os.utime(target, (zip_epoch, zip_epoch))
+
+def compile_bytecode(staging_dir, runtime, root):
+    """Compile the staged sources with the runtime's interpreter.
+
+    Function code lives on a read-only filesystem, so bytecode not shipped in
+    the package is compiled again on every cold start. Bytecode only works on
+    the interpreter version it was compiled with, so this is skipped (with a
+    warning) if no interpreter for `runtime` (e.g. `python3.6`) is found.
+
+    Returns how many files were compiled.
+    """
+    interpreter = runtime_interpreter(runtime)
+
+    if not interpreter:
+        print('WARNING: no {} interpreter found; shipping sources only'.format(runtime))
+        return 0
+
+    # Tracebacks show the paths the files end up on. A fixed hash seed keeps
+    # set constants (written in hash order) the same across builds, so
+    # packages stay byte-identical.
+    result = subprocess.run(
+        [interpreter, '-m', 'compileall', '-q', '-d', root, staging_dir],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        env=dict(os.environ, PYTHONHASHSEED='0')
+    )
+
+    # Some dependencies ship files that don't compile (e.g. Python 2 only
+    # code they never import); those are simply left uncompiled
+    if result.returncode != 0:
+        print('WARNING: some files could not be compiled with {}'.format(runtime))
+
+    return len([
+        path for path in list_files(staging_dir, bytecode=True)
+        if path.endswith('.pyc')
+    ])
+
+@functools.lru_cache()
+def runtime_interpreter(runtime):
+    # The interpreter for `runtime` (e.g. python3.6), if it's around
+    version = runtime[len('python'):]
+
+    if '{}.{}'.format(*sys.version_info) == version:
+        return sys.executable
+
+    interpreter = shutil.which(runtime)
+
+    if not interpreter:
+        return None
+
+    # Shims (e.g. pyenv's) may exist for interpreters that don't
+    check = subprocess.run(
+        [interpreter, '-c', 'import sys; print("{}.{}".format(*sys.version_info))'],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+
+    if check.returncode != 0 or check.stdout.decode('utf-8').strip() != version:
+        return None
+
+    return interpreter
+
+def write_zip_entry(package, arcname, path):
+    info = zipfile.ZipInfo(arcname.replace(os.sep, '/'), zip_date_time)
+    info.compress_type = package.compression
+    info.create_system = 3
+
+    # `ZipFile.open()` only honors the level set on the entry itself, which
+    # `ZipInfo` has no public setter for until Python 3.13
+    info._compresslevel = package.compresslevel
+
+    # Keep only whether the file is executable
+    if os.stat(path).st_mode & 0o111:
+        info.external_attr = 0o100755 << 16
+    else:
+        info.external_attr = 0o100644 << 16
+
+    # Stream the file into the archive rather than reading it whole
+    with open(path, 'rb') as source, package.open(info, 'w') as dest:
+        shutil.copyfileobj(source, dest, 1024 * 1024)
+
 def setup_dependencies(function_name):
-    if os.path.exists('{}/requirements.txt'.format(function_name)):
-        cmd = 'pip3 install -r {0}/requirements.txt -t _dependencies/{0} '.format(function_name)
-        subprocess.run(cmd, check=True, shell=True)
+    """Return the directory holding the function's dependencies, if any.
+
+    Dependency trees are cached by requirements hash, so they are installed
+    once and then shared by every run and every function with the same
+    requirements.
+    """
+    requirements_path = '{}/requirements.txt'.format(function_name)
+
+    if not os.path.exists(requirements_path):
+        return None
+
+    dependencies_dir = os.path.join(
+        dependencies_cache_dir, requirements_hash(requirements_path)
+    )
+
+    if os.path.isdir(dependencies_dir):
+        print('Using cached dependencies for {}'.format(function_name))
+        return dependencies_dir
+
+    # Install somewhere private and move it in place once complete, so other
+    # workers never see a half-installed tree
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=dependencies_cache_dir)
+
+    try:
+        install_dependencies(requirements_path, tmp_dir)
+
+        try:
+            os.rename(tmp_dir, dependencies_dir)
+
+        # Another worker with identical requirements got there first
+        except OSError:
+            shutil.rmtree(tmp_dir)
+    except:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    return dependencies_dir
+
+def install_dependencies(requirements_path, target_dir):
+    install_cmd = [
+        'pip3', 'install', '--no-index', '--find-links', wheels_cache_dir,
+        '-r', requirements_path, '-t', target_dir
+    ]
+
+    # Try the local wheel cache first; it has everything unless requirements
+    # changed
+    offline = subprocess.run(
+        install_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+    if offline.returncode == 0:
+        return
+
+    # Fetch (or build) whatever is missing into the wheel cache and retry
+    shutil.rmtree(target_dir)
+    os.makedirs(target_dir)
+
+    subprocess.run(
+        ['pip3', 'wheel', '-r', requirements_path, '-w', wheels_cache_dir],
+        check=True
+    )
+    subprocess.run(install_cmd, check=True)
+
+def requirements_hash(requirements_path):
+    # Comments, blank lines, whitespace, case and ordering don't change what
+    # gets installed, so they don't change the hash either
+    requirements = set()
+
+    with open(requirements_path) as requirements_file:
+        for line in requirements_file:
+            line = ''.join(line.split('#', 1)[0].split()).lower()
+
+            if line:
+                requirements.add(line)
+
+    return sha256('\n'.join(sorted(requirements)).encode('utf-8')).hexdigest()
+
+def config_hash(config, layer_hash=None):
+    # Must match how `lambdaMetaDeployer` hashes configs. The layer is part of
+    # the function's configuration, so a new one means a config update.
+    if layer_hash:
+        config = dict(config, layer=layer_hash)
+
+    return md5(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
 
 def validate_config(config):
     if not 'memory' in config:
@@ -112,14 +872,75 @@ def validate_config(config):
     if not 'handler' in config:
         error('config', 'missing_handler')
 
+    for path in config.get('include', []):
+        if not os.path.isfile(path):
+            error('config', 'missing_include_{}'.format(path))
+
+    if not config.get('runtime', default_runtime).startswith('python3.'):
+        error('config', 'invalid_runtime')
+
+def print_summary(results):
+    print('Deploy summary:')
+
+    for function_name in sorted(results):
+        print('  {}: {}'.format(function_name, results[function_name]))
+
+    # Throttled calls were retried; worth knowing about when deploys slow down
+    for name, count in sorted(rate_control.throttles.items()):
+        print('  Throttled {} call(s) to {}'.format(count, name))
+
+def failed(results):
+    return [
+        name for name, result in results.items()
+        if result not in ['deployed', 'unchanged']
+    ]
+
 def error(major, minor):
     raise Exception(major + '_' + minor)
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='Package and deploy functions')
+    parser.add_argument(
+        'functions', nargs='*',
+        help='Functions to deploy (defaults to every function in the repo)'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='How many functions to package and deploy concurrently'
+    )
+    parser.add_argument(
+        '-b', '--batch-size', type=int, default=10,
+        help='How many functions to deploy per lambdaMetaDeployer invoke'
+    )
+    parser.add_argument(
+        '-z', '--compression-level', type=int, default=9, choices=range(10),
+        metavar='[0-9]',
+        help='Zip compression level; 0 stores files uncompressed (default: 9)'
+    )
+    parser.add_argument(
+        '-f', '--force', action='store_true',
+        help='Build and deploy functions even if they haven\'t changed since last deploy'
+    )
+
+    return parser.parse_args()
+
 if __name__ == '__main__':
+    args = parse_args()
+
     bootstrap()
 
-    if len(sys.argv) == 1:
-        scan_folders()
-    else:
-        for function_name in sys.argv[1:]:
-            deploy(function_name)
+    function_names = args.functions or scan_folders()
+    results = deploy_all(
+        function_names,
+        max(args.jobs, 1),
+        max(args.batch_size, 1),
+        args.compression_level,
+        args.force
+    )
+
+    print_summary(results)
+    metrics.summary()
+
+    if failed(results):
+        print('Some functions were not deployed')
+        sys.exit(1)
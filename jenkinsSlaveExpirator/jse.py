@@ -1,30 +1,73 @@
 from datetime import datetime
-import boto3
+import metrics
+import slave_reaper
+import slave_registry
+import slave_requests
 
-ec2_client = boto3.client('ec2', region_name='us-east-1')
+@metrics.handler
+def lambda_handler(event, _context):
+    now = datetime.utcnow()
 
-def lambda_handler(_event, _context):
-    query = ec2_client.describe_instances(
-        Filters=[
-            {
-                'Name': 'tag-key',
-                'Values': ['jenkins_slave_expiration_date']
-            },
-            {
-                'Name': 'instance-state-code',
-                'Values': ['0', '16']
-            }
-        ],
-    )['Reservations']
+    # Async launches whose slaves were never tagged nor registered (no
+    # fulfillment event, and the caller never polled) would never expire
+    with metrics.phase('complete'):
+        slave_requests.complete_active_requests()
 
-    print('Found {} matching instances...'.format(len(query)))
+    # Only the slaves that are due, straight from the registry's index
+    with metrics.phase('find'):
+        entries = slave_registry.find_expired(now)
 
-    for instance in query:
-        if len(instance['Instances']) > 1:
-            print('Not sure what this means')
+    print('Found {} expired entries on the registry...'.format(len(entries)))
 
-        data = instance['Instances'][0]
+    expired = []
+    skipped = 0
 
+    if entries:
+        with metrics.phase('find'):
+            expired = slave_reaper.find_instances(
+                instance_ids=[entry['instance_id'] for entry in entries]
+            )
+
+    # Also look for slaves that never made it to the registry (e.g. launched
+    # before it existed). Unlike the above, this goes through every slave.
+    if event and event.get('full_scan'):
+        with metrics.phase('full_scan'):
+            scanned, not_due = scan_expired_slaves(now)
+
+        # Slaves on the registry are found both ways
+        expired = list({data['InstanceId']: data for data in expired + scanned}.values())
+        expired_ids = set(data['InstanceId'] for data in expired)
+
+        skipped = len([data for data in not_due if data['InstanceId'] not in expired_ids])
+
+    # Healthy pool slaves go back to their pool instead
+    with metrics.phase('reap'):
+        report, failed = slave_reaper.reap(expired)
+    report['skipped'] += skipped
+
+    print('Expired slaves: {}'.format(report))
+
+    # Either terminated, gone already or registered again under a pool's tag.
+    # Slaves that failed to terminate stay, so the next run retries them.
+    with metrics.phase('unregister'):
+        slave_registry.unregister([
+            entry for entry in entries if entry['instance_id'] not in failed
+        ])
+
+    return report
+
+def scan_expired_slaves(now):
+    # Returns the expired slaves, and the ones that aren't due yet
+    instances = slave_reaper.find_instances([
+        {'Name': 'tag-key', 'Values': ['jenkins_slave_expiration_date']}
+    ])
+
+    print('Found {} matching instances...'.format(len(instances)))
+
+    expired = []
+    not_due = []
+
+    for data in instances:
         expiration_date = None
 
         for tag in data['Tags']:
@@ -32,11 +75,9 @@ def lambda_handler(_event, _context):
                 expiration_date = datetime.strptime(tag['Value'], '%Y-%m-%d %H:%M:%S.%f')
                 break;
 
-        if datetime.utcnow() >= expiration_date:
-            instance_id = data['InstanceId']
-
-            print('Terminating instance {}'.format(instance_id))
+        if now >= expiration_date:
+            expired.append(data)
+        else:
+            not_due.append(data)
 
-            ec2_client.terminate_instances(
-                InstanceIds=[instance_id]
-            )
+    return expired, not_due
@@ -1,11 +1,33 @@
 import json
-from datetime import datetime, timedelta
-import boto3
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import dynamo_codec
+import dynamo_lease
+import lambda_runtime
+import metrics
+import slave_pool
+import slave_registry
+import slave_requests
+import spot_price_history
 
 # Helper values
 
-ec2_client = boto3.client('ec2', region_name='us-east-1')
-dynamo_client = boto3.client('dynamodb', region_name='us-east-1')
+# Spot prices are collected concurrently, at most `price_fetch_workers` calls
+# at once, each one bounded by the client timeouts
+price_fetch_workers = 12
+
+ec2_client = lambda_runtime.client(
+    'ec2',
+    connect_timeout=2,
+    read_timeout=5,
+    retries={'max_attempts': 2},
+    max_pool_connections=price_fetch_workers
+)
+dynamo_client = lambda_runtime.client('dynamodb')
+lambda_client = lambda_runtime.client('lambda')
 
 default_small_instances = ['c5.large', 'm4.large', 'c4.large']
 default_large_instances = ['c5.2xlarge', 'm4.2xlarge', 'c4.2xlarge']
@@ -21,7 +43,8 @@ default_instance_map = {
     'small-3': default_small_instances,
 }
 
-# TODO: Fetch AMI dynamically from tags or cache
+# AMIs and snapshots are looked up by tag (see `get_launch_metadata()`); these
+# are only used for roles without a tagged AMI
 role_map = {
     'helix': {
         'ami_id': 'ami-f109c38c',
@@ -44,140 +67,723 @@ max_price_map = {
     'c4.2xlarge': 0.115
 }
 
-all_azs = [
-    'us-east-1a',
-    'us-east-1b',
-    'us-east-1c',
-    'us-east-1d',
-    'us-east-1e',
-    'us-east-1f'
-]
+# Same for the slave subnet of each AZ (and with it, the AZs in use)
+default_subnets = {
+    'us-east-1a': 'subnet-2c82724b',
+    'us-east-1b': 'subnet-16fb1a38',
+    'us-east-1c': 'subnet-e7ce65ad',
+    'us-east-1d': 'subnet-2d836471',
+    'us-east-1e': 'subnet-49fffc76',
+    'us-east-1f': 'subnet-abd154a4'
+}
+
+# AMIs are tagged with the role they boot, and subnets meant for slaves with
+# `subnet_tag` (whatever its value)
+image_role_tag = 'jenkins_slave_role'
+subnet_tag = 'jenkins_slave_subnet'
+
+# The latest AMI/snapshot of every role and the subnet of every AZ, kept in
+# memory and on `kv_cache`. They hardly ever change, so they're only looked up
+# again once `launch_metadata_ttl` is over (or after `launch_metadata_retry`,
+# if the lookup failed and the previous or default values are used meanwhile).
+kv_cache_table = 'kv_cache'
+launch_metadata_key = 'jsl#launch_metadata'
+launch_metadata_ttl = 6 * 60 * 60
+launch_metadata_retry = 5 * 60
+launch_metadata = {'metadata': None}
+launch_metadata_lock = threading.Lock()
 
 spot_price_cache_table = 'spot_price_cache'
-
+# Only the holder of this lease collects spot prices; everyone else waits for
+# its result to show up on `spot_price_cache`
+collector_lease_key = 'spot_price_cache#collector'
+collector_lease_duration = 60
+collector_wait_attempts = 6
+collector_wait_delay = 1
+
+# The price history of every instance type/AZ pair lives on a single
+# `spot_price_cache` item, and each collection only fetches what changed since
+# the previous one (its watermark, minus some overlap for late datapoints)
+price_history_key = 'history'
+price_history_overlap = 10 * 60
+
+# AZs whose price swings too much (standard deviation over the day's mean), or
+# is spiking above its mean right now, are only used when no other AZ is left
+max_price_volatility = 0.25
+max_price_spike = 1.5
+
+# Longer than any refill may take (i.e. the function timeout)
+pool_refill_lease_duration = 60
+
+# Spot prices are also kept in memory, across warm invocations. Once the hour
+# rolls over, the previous hour's prices keep being served, for at most
+# `price_cache_ttl` after they were generated, while a single refresh runs in
+# the background.
+price_cache = {'entry': (None, None)}
+price_cache_ttl = timedelta(minutes=75)
+price_refresh_lock = threading.Lock()
+price_refresh = None
+
+@metrics.handler
 def lambda_handler(event, context):
+    # A spot request was fulfilled (EventBridge event); tag its instance
+    if event.get('detail-type') == 'EC2 Spot Instance Request Fulfillment':
+        slave_requests.complete_spot_requests([event['detail']['spot-instance-request-id']])
+        return
+
+    # Caller polling an asynchronous launch
+    if event.get('action') == 'status':
+        return spot_requests_status(event['spot_request_ids'])
+
+    # Top up warm pools (all of them, unless role and size are given)
+    if event.get('action') == 'refill':
+        return refill_pools(event.get('role'), event.get('size'))
+
     role = event['role']
     size = event['size']
     tag = event['tag']
     max_duration = int(event['max_duration'])
+    count = int(event.get('count', 1))
+    spread = bool(event.get('spread', False))
+
+    if count < 1:
+        raise Exception('Count must be at least 1 for {}-{} (got {})'.format(role, tag, count))
 
     if max_duration >= 60:
         print('Max duration must no be >= 60 for {}-{}'.format(role, tag))
         max_duration = 60
-    
-    instance_id = launch_spot(role, size, tag, max_duration)
+
+    # Ready slaves from the warm pool go first; only the rest is launched
+    claimed = slave_pool.claim_slaves(
+        role, size, tag,
+        datetime.utcnow() + timedelta(minutes = max_duration),
+        count
+    )
+
+    # Whether slaves were claimed or the pool came up short (e.g. empty, or its
+    # idle slaves expired), it's missing some now
+    if slave_pool.get_pool(role, size):
+        request_pool_refill(context, role, size)
+
+    count -= len(claimed)
+
+    # Return as soon as the spot requests are placed; instances are tagged
+    # once fulfilled, and the caller polls for them with `status`
+    if event.get('async'):
+        spot_request_ids = []
+
+        if count:
+            spot_request_ids = launch_spot_async(role, size, tag, max_duration, count, spread)
+
+        return {
+            'instance_ids': claimed,
+            'spot_request_ids': spot_request_ids,
+            'status': 'pending' if spot_request_ids else 'fulfilled'
+        }
+
+    instance_ids = claimed
+
+    if count:
+        instance_ids += launch_spot(role, size, tag, max_duration, count, spread)
 
     return {
-        'instance_id': instance_id
+        'instance_id': instance_ids[0],
+        'instance_ids': instance_ids
     }
 
 # Helper methods
 
-def launch_spot(role, size, tag, max_duration):
-    spot = select_spot_instance(role, size)
+def launch_spot(role, size, tag, max_duration, count=1, spread=False, extra_tags=None):
+    """Launch `count` slaves, returning their instance ids.
 
-    instance_type = spot['instance_type']
-    max_price = spot['max_price']
-    az = spot['az']
+    All slaves are requested, waited for and tagged together. With `spread`,
+    they are split over the cheapest AZs (one spot request per AZ) instead of
+    all landing on the single cheapest one.
+    """
+    expiration_date = datetime.utcnow() + timedelta(minutes = max_duration)
+
+    spot_request_ids = request_spot(
+        role, size, tag, expiration_date, count, spread
+    )
 
+    with metrics.phase('fulfillment'):
+        instance_ids = get_instance_ids_from_spot_requests(spot_request_ids)
+
+    # Add tags on instances. Whatever was fulfilled gets tagged, even if some
+    # requests weren't, so the expirator can still find them.
+    if instance_ids:
+        with metrics.phase('tagging'):
+            ec2_client.create_tags(
+                Resources=instance_ids,
+                Tags=slave_tags(role, size, tag, expiration_date) + (extra_tags or [])
+            )
+
+            slave_registry.register(tag, instance_ids, expiration_date)
+
+    if len(instance_ids) < count:
+        raise Exception('Only {} out of {} slaves were launched for {}-{}'.format(
+            len(instance_ids), count, role, tag
+        ))
+
+    return instance_ids
+
+def launch_spot_async(role, size, tag, max_duration, count=1, spread=False):
+    """Request `count` slaves without waiting for them.
+
+    The slave tags are put on the spot requests themselves, and copied over
+    to each instance (see `slave_requests`) when EC2 reports the request as
+    fulfilled, when the caller polls for its status or, failing both, on the
+    expirator's next run.
+    """
     expiration_date = datetime.utcnow() + timedelta(minutes = max_duration)
 
-    # Create the spot request
-    spot_request_id = ec2_client.request_spot_instances(
-        ClientToken='{}-{}-{}'.format(role, size, tag),
-        InstanceCount=1,
-        LaunchSpecification=generate_launch_spec(role, spot, tag),
-        SpotPrice=str(max_price),
-        Type='one-time',
-        ValidUntil=expiration_date.timestamp()
-    )['SpotInstanceRequests'][0]['SpotInstanceRequestId']
-
-    instance_id = get_instance_id_from_spot_request(spot_request_id)
-
-    # Add tags on instance
-    ec2_client.create_tags(
-        Resources=[instance_id,],
-        Tags=[
-            {'Key': 'jenkins_slave_role', 'Value': role},
-            {'Key': 'jenkins_slave_size', 'Value': size},
-            {'Key': 'jenkins_slave_tag', 'Value': tag},
-            {'Key': 'jenkins_slave_expiration_date', 'Value': str(expiration_date)},
-            {'Key': 'Name', 'Value': 'slave-{}-{}'.format(role, tag)},
-            {'Key': 'Stage', 'Value': 'Build'},
-            {'Key': 'Role', 'Value': 'JenkinsSlave'}
-        ]
+    return request_spot(
+        role, size, tag, expiration_date, count, spread,
+        request_tags=slave_tags(role, size, tag, expiration_date)
     )
 
-    return instance_id
+def request_spot(role, size, tag, expiration_date, count, spread, request_tags=None):
+    # Place the spot requests for `count` slaves, returning their ids
+    with metrics.phase('price_lookup'):
+        spot = select_spot_instance(role, size)
+
+    if spread and count > 1:
+        placements = spread_spot_instance(spot, count)
+    else:
+        placements = [(spot, count)]
+
+    extra_args = {}
+
+    if request_tags:
+        extra_args['TagSpecifications'] = [
+            {'ResourceType': 'spot-instances-request', 'Tags': request_tags}
+        ]
+
+    metadata = get_launch_metadata()
+    spot_request_ids = []
+
+    with metrics.phase('spot_request'):
+        for placement_spot, placement_count in placements:
+            client_token = '{}-{}-{}'.format(role, size, tag)
+
+            if len(placements) > 1:
+                client_token += '-{}'.format(placement_spot['az'])
+
+            # Create the spot request
+            spot_request_ids += [
+                request['SpotInstanceRequestId']
+                for request in ec2_client.request_spot_instances(
+                    ClientToken=client_token,
+                    InstanceCount=placement_count,
+                    LaunchSpecification=generate_launch_spec(
+                        role, placement_spot, tag, metadata
+                    ),
+                    SpotPrice=str(placement_spot['max_price']),
+                    Type='one-time',
+                    ValidUntil=expiration_date.timestamp(),
+                    **extra_args
+                )['SpotInstanceRequests']
+            ]
+
+    return spot_request_ids
+
+def slave_tags(role, size, tag, expiration_date):
+    return [
+        {'Key': 'jenkins_slave_role', 'Value': role},
+        {'Key': 'jenkins_slave_size', 'Value': size},
+        {'Key': 'jenkins_slave_tag', 'Value': tag},
+        {'Key': 'jenkins_slave_expiration_date', 'Value': str(expiration_date)},
+        {'Key': 'Name', 'Value': 'slave-{}-{}'.format(role, tag)},
+        {'Key': 'Stage', 'Value': 'Build'},
+        {'Key': 'Role', 'Value': 'JenkinsSlave'}
+    ]
+
+def spot_requests_status(spot_request_ids):
+    requests = slave_requests.complete_spot_requests(spot_request_ids)
+
+    instance_ids = [r['InstanceId'] for r in requests if 'InstanceId' in r]
+    unfulfilled = [r for r in requests if 'InstanceId' not in r]
+
+    if not unfulfilled:
+        status = 'fulfilled'
+
+    # Some request will never get an instance
+    elif any(r['State'] in ['cancelled', 'failed', 'closed'] for r in unfulfilled):
+        status = 'failed'
 
-def generate_spot_cache():
+    else:
+        status = 'pending'
+
+    return {
+        'status': status,
+        'instance_ids': instance_ids,
+        'spot_requests': [
+            {
+                'spot_request_id': r['SpotInstanceRequestId'],
+                'state': r['State'],
+                'status_code': r.get('Status', {}).get('Code'),
+                'instance_id': r.get('InstanceId')
+            }
+            for r in requests
+        ]
+    }
+
+def refill_pools(role=None, size=None):
+    """Launch however many idle slaves each warm pool is missing.
+
+    Only one refill per pool runs at a time, so concurrent refills never
+    overshoot. Returns how many slaves were launched per pool.
+    """
     result = {}
+
+    for name, pool in slave_pool.pool_map.items():
+        if role and (pool['role'], pool['size']) != (role, size):
+            continue
+
+        lease_key = 'slave_pool#refill#{}'.format(name)
+        lease = dynamo_lease.acquire_lease(lease_key, pool_refill_lease_duration)
+
+        if not lease:
+            print('Pool {} is already being refilled'.format(name))
+            continue
+
+        try:
+            missing = pool['slaves'] - len(slave_pool.find_idle_slaves(name))
+
+            if missing > 0:
+                print('Launching {} slaves into pool {}'.format(missing, name))
+
+                # Every refill gets its own tag, so its spot requests don't
+                # collide (`ClientToken`) with the ones of previous refills
+                launch_spot(
+                    pool['role'],
+                    pool['size'],
+                    'pool-{}-{}'.format(name, uuid.uuid4().hex[:8]),
+                    pool['max_age'],
+                    missing,
+                    spread=True,
+                    extra_tags=slave_pool.member_tags(name)
+                )
+
+            result[name] = max(missing, 0)
+        finally:
+            dynamo_lease.release_lease(lease_key, lease)
+
+    return result
+
+def request_pool_refill(context, role, size):
+    # Refill in a separate invocation, so this launch doesn't wait for it
+    lambda_client.invoke(
+        FunctionName=context.function_name,
+        InvocationType='Event',
+        Payload=json.dumps({'action': 'refill', 'role': role, 'size': size})
+    )
+
+def spread_spot_instance(spot, count):
+    """Split `count` instances of the selected spot over the cheapest AZs.
+
+    Returns a list of (spot, count) tuples, one per AZ. Only AZs with a slave
+    subnet, under the max price (and stable, see `is_stable_az()`) are used,
+    unless none is (and then only the selected one).
+    """
+    prices = get_spot_prices([spot['instance_type']])[spot['instance_type']]
+    subnets = get_launch_metadata()['subnets']
+
+    azs = sorted(
+        (prices[az], az) for az in prices['stats']
+        if az in subnets and prices[az] < spot['max_price'] and is_stable_az(prices, az)
+    )
+    azs = [az for price, az in azs][:count] or [spot['az']]
+
+    placements = []
+
+    for i, az in enumerate(azs):
+        az_count = count // len(azs) + (1 if i < count % len(azs) else 0)
+        placements.append((dict(spot, az=az), az_count))
+
+    return placements
+
+def get_spot_prices(instances=None):
+    """Return the current spot prices, from memory whenever possible.
+
+    Only `instances` (all of them by default) are guaranteed to be there.
+    """
+    instances = instances or all_instances
+
     now = datetime.utcnow()
     timestamp = now.replace(minute=0, second=0, microsecond=0)
 
+    cached_timestamp, cached_prices = price_cache['entry']
+    cached = cached_prices is not None and all(
+        instance in cached_prices for instance in instances
+    )
+
+    if cached and cached_timestamp == timestamp:
+        return cached_prices
+
+    # Last hour's prices are still good enough; don't make the launch wait
+    if cached and now - cached_timestamp < price_cache_ttl:
+        refresh_spot_prices(instances)
+        return cached_prices
+
+    return generate_spot_cache(instances=instances)
+
+def refresh_spot_prices(instances):
+    # Regenerate the prices in the background, unless that's already going on.
+    # Note the thread is frozen along with the container once the invocation
+    # returns, and resumes on the next one.
+    global price_refresh
+
+    with price_refresh_lock:
+        if price_refresh and price_refresh.is_alive():
+            return
+
+        price_refresh = threading.Thread(
+            target=generate_spot_cache_quietly, args=(instances,)
+        )
+        price_refresh.daemon = True
+        price_refresh.start()
+
+def generate_spot_cache_quietly(instances):
+    try:
+        generate_spot_cache(instances=instances)
+    except Exception as e:
+        print('Unable to refresh spot prices: {}'.format(e))
+
+def generate_spot_cache(timestamp=None, block=True, instances=None):
+    """Return the spot prices of the hour starting at `timestamp`.
+
+    Prices come from the DynamoDB cache, or are collected (and cached) if not
+    there yet. Only one collector runs at a time: if someone else holds the
+    collector lease, we wait for their result instead, or return None right
+    away when `block` is False.
+
+    Cached prices are only read for `instances` (all of them by default), while
+    collected ones cover every instance type.
+    """
+    now = datetime.utcnow()
+
+    if not timestamp:
+        timestamp = now.replace(minute=0, second=0, microsecond=0)
+
+    instances = instances or all_instances
+
+    result = load_spot_cache(timestamp, instances)
+
+    # Found an entry on the cache
+    if result:
+        return result
+
+    lease = dynamo_lease.acquire_lease(
+        collector_lease_key, collector_lease_duration
+    )
+
+    if not lease:
+        if not block:
+            return None
+
+        result = wait_for_spot_cache(timestamp, instances)
+
+        if result:
+            return result
+
+        # The launch can't wait forever; collect the prices ourselves
+        print('Timed out waiting for spot prices to be collected')
+
+    # The lease is held until the entry is there (or we gave up on caching
+    # it), so nobody collects the same hour again in between
+    try:
+        with metrics.phase('price_collection'):
+            result, failures = collect_spot_prices()
+
+        # Don't cache a partial price list; the next launch will try again
+        if failures:
+            print('Failed to fetch {} spot prices; not caching'.format(failures))
+            return result
+
+        expiration_date = now.timestamp() + (24 * 60 * 60)
+
+        # Save result on cache, as a map of instance types so readers can pick
+        # just the ones they need
+        resp = dynamo_client.put_item(
+            TableName=spot_price_cache_table,
+            Item=dynamo_codec.encode_item({
+                'timestamp': str(timestamp),
+                'prices': result,
+                'expiration_date': expiration_date
+            })
+        )
+    finally:
+        if lease:
+            dynamo_lease.release_lease(collector_lease_key, lease)
+
+    remember_spot_prices(timestamp, result)
+
+    return result
+
+def load_spot_cache(timestamp, instances):
+    # Instance types have dots, so every one of them needs a placeholder
+    names = {'#prices': 'prices'}
+    paths = []
+
+    for i, instance in enumerate(instances):
+        names['#i{}'.format(i)] = instance
+        paths.append('#prices.#i{}'.format(i))
+
     resp = dynamo_client.get_item(
         TableName=spot_price_cache_table,
         Key={
             'timestamp': {'S': str(timestamp)}
-        }
+        },
+        ProjectionExpression=', '.join(paths),
+        ExpressionAttributeNames=names
     )
 
-    # Found an entry on the cache
-    if 'Item' in resp:
-        return json.loads(resp['Item']['prices']['S'])
-
-    # Generate price list
-    # <rant> Yes, it's one request per instance-type per AZ. That's because AWS's
-    # API (`describe-spot-price-history`) really really sucks. For example,
-    # filtering the results wouldn't guarantee a result on all AZs, since unchanged
-    # prices do not create datapoints on their timeseries (or create with a larger
-    # interval). Hence the cache.</rant>
-    for instance in all_instances:
-        result[instance] = {'cheapest': {'price': 999}}
+    result = dynamo_codec.decode_item(resp.get('Item', {})).get('prices')
+
+    # Not there (or cached before prices were kept as a map)
+    if not isinstance(result, dict) or not all(instance in result for instance in instances):
+        return None
+
+    remember_spot_prices(timestamp, result)
+
+    return result
 
-        for az in all_azs:
+def wait_for_spot_cache(timestamp, instances):
+    for attempt in range(collector_wait_attempts):
+        time.sleep(collector_wait_delay)
+
+        result = load_spot_cache(timestamp, instances)
+
+        if result:
+            return result
+
+    return None
+
+def remember_spot_prices(timestamp, prices):
+    cached_timestamp, cached_prices = price_cache['entry']
+
+    # Never replace newer prices (e.g. by a slow background refresh)
+    if cached_timestamp and cached_timestamp > timestamp:
+        return
+
+    # Prices of the same hour may have been read for other instance types
+    if cached_timestamp == timestamp:
+        prices = dict(cached_prices, **prices)
+
+    # Timestamp and prices are swapped together, so readers on other threads
+    # never see one without the other
+    price_cache['entry'] = (timestamp, prices)
+
+def collect_spot_prices():
+    """Bring the price history up to date, and list the prices from it.
+
+    Returns the price list along with how many prices could not be fetched.
+    Those are simply left out; an instance type without any price keeps a
+    `cheapest` entry with no AZ, which `select_spot_instance()` skips.
+    """
+    now = time.time()
+
+    history = load_price_history()
+    failures = refresh_price_history(history, now)
+
+    spot_price_history.trim(history, now)
+    save_price_history(history)
+
+    return build_price_list(history, now), failures
+
+def price_pairs():
+    pairs = []
+
+    for instance in all_instances:
+        for az in sorted(get_launch_metadata()['subnets']):
             # M5 family not available at `us-east-1e` AZ
             if instance.startswith('m5') and az == 'us-east-1e':
                 continue
 
-            price = float(ec2_client.describe_spot_price_history(
-                ProductDescriptions=['Linux/UNIX'],
-                InstanceTypes=[instance],
-                AvailabilityZone=az,
-                MaxResults=1
-            )['SpotPriceHistory'][0]['SpotPrice'])
+            pairs.append((instance, az))
+
+    return pairs
+
+def refresh_price_history(history, now):
+    """Add the datapoints published since the history's watermark.
+
+    Returns how many pairs still have no price at all.
+    """
+    start = history['watermark'] or now - spot_price_history.window
+    pairs = price_pairs()
+    failures = 0
+
+    try:
+        points = fetch_spot_price_history(start)
+    except Exception as e:
+        print('Unable to fetch spot price history: {}'.format(e))
+        failures += 1
+    else:
+        wanted = set(pairs)
+
+        for point in sorted(points, key=lambda point: point['Timestamp']):
+            pair = (point['InstanceType'], point['AvailabilityZone'])
+
+            if pair in wanted:
+                spot_price_history.add_point(
+                    history, pair[0], pair[1],
+                    point['Timestamp'].timestamp(), float(point['SpotPrice'])
+                )
+
+        history['watermark'] = int(now) - price_history_overlap
+
+    # <rant> AWS's API (`describe-spot-price-history`) really really sucks.
+    # Unchanged prices do not create datapoints on their timeseries (or create
+    # with a larger interval), so a pair may have none over the whole window.
+    # Those need a request each, for their latest price.</rant>
+    # At least the requests are independent, so they run concurrently.
+    missing = [
+        (instance, az) for instance, az in pairs
+        if not spot_price_history.has_series(history, instance, az)
+    ]
+
+    with ThreadPoolExecutor(max_workers=price_fetch_workers) as executor:
+        futures = [
+            executor.submit(fetch_spot_price, instance, az)
+            for instance, az in missing
+        ]
+
+    for (instance, az), future in zip(missing, futures):
+        try:
+            timestamp, price = future.result()
+        except Exception as e:
+            print('Unable to fetch spot price of {} on {}: {}'.format(instance, az, e))
+            failures += 1
+            continue
+
+        spot_price_history.add_point(history, instance, az, timestamp, price)
+
+    return failures
+
+def fetch_spot_price_history(start):
+    # Every instance type on every AZ, in a single (paginated) query
+    paginator = ec2_client.get_paginator('describe_spot_price_history')
+    points = []
 
-            result[instance][az] = price
+    for page in paginator.paginate(
+        ProductDescriptions=['Linux/UNIX'],
+        InstanceTypes=all_instances,
+        StartTime=datetime.fromtimestamp(start, timezone.utc)
+    ):
+        points += page['SpotPriceHistory']
 
-            if price < result[instance]['cheapest']['price']:
-                result[instance]['cheapest'] = {
-                    'price': price,
-                    'az': az
-                }
+    return points
 
-    expiration_date = now.timestamp() + (24 * 60 * 60)
+def fetch_spot_price(instance, az):
+    point = ec2_client.describe_spot_price_history(
+        ProductDescriptions=['Linux/UNIX'],
+        InstanceTypes=[instance],
+        AvailabilityZone=az,
+        MaxResults=1
+    )['SpotPriceHistory'][0]
 
-    # Save result on cache
-    resp = dynamo_client.put_item(
+    return point['Timestamp'].timestamp(), float(point['SpotPrice'])
+
+def load_price_history():
+    resp = dynamo_client.get_item(
+        TableName=spot_price_cache_table,
+        Key={
+            'timestamp': {'S': price_history_key}
+        }
+    )
+
+    if 'Item' not in resp:
+        return spot_price_history.empty()
+
+    try:
+        return spot_price_history.decode(resp['Item']['history']['B'])
+    except Exception as e:
+        # Start over, rather than never collecting prices again
+        print('Unable to decode spot price history: {}'.format(e))
+        return spot_price_history.empty()
+
+def save_price_history(history):
+    # No expiration; a history that's too old simply gets refetched in full
+    dynamo_client.put_item(
         TableName=spot_price_cache_table,
         Item={
-            'timestamp': {'S': str(timestamp)},
-            'prices': {'S': json.dumps(result)},
-            'expiration_date': {'N': str(expiration_date)}
+            'timestamp': {'S': price_history_key},
+            'history': {'B': spot_price_history.encode(history)}
         }
     )
 
+def build_price_list(history, now):
+    """List the current price of every instance type on every AZ.
+
+    Along with the rolling stats of each AZ's price over the history window,
+    and the cheapest AZ, preferring stable ones (see `is_stable_az()`).
+    """
+    result = {}
+
+    for instance in all_instances:
+        result[instance] = {'cheapest': {'price': 999}, 'stats': {}}
+
+    for instance, az in price_pairs():
+        stats = spot_price_history.stats(history, instance, az, now)
+
+        if not stats:
+            continue
+
+        result[instance][az] = stats['price']
+        result[instance]['stats'][az] = {
+            'min': stats['min'],
+            'mean': round(stats['mean'], 6),
+            'volatility': round(stats['volatility'], 4)
+        }
+
+    for instance, prices in result.items():
+        prices['cheapest'] = cheapest_az(prices, prices['stats'])
+
     return result
 
-def select_spot_instance(role, size):
-    price_list = generate_spot_cache()
+def cheapest_az(prices, azs):
+    # The cheapest of `azs` with a price, preferring stable ones. Without any,
+    # there's no AZ (and a price no one goes under).
+    azs = sorted((prices[az], az) for az in azs if az in prices['stats'])
+    stable_azs = [(price, az) for price, az in azs if is_stable_az(prices, az)]
+
+    if not azs:
+        return {'price': 999}
+
+    price, az = (stable_azs or azs)[0]
+
+    return {'price': price, 'az': az}
+
+def is_stable_az(prices, az):
+    stats = prices['stats'][az]
 
+    return (
+        stats['volatility'] <= max_price_volatility and
+        prices[az] <= stats['mean'] * max_price_spike
+    )
+
+def select_spot_instance(role, size):
     possible_instances = role_map[role]['instance_type'][size]
 
+    price_list = get_spot_prices(possible_instances)
+
+    # Cached prices may list AZs we no longer have a slave subnet on, so the
+    # cheapest AZ of each instance is picked among the ones we do
+    subnets = get_launch_metadata()['subnets']
+    cheapest_map = {
+        instance: cheapest_az(price_list[instance], subnets)
+        for instance in possible_instances
+    }
+
     selected = None
     for instance in possible_instances:
         max_price = max_price_map[instance]
-        cheapest = price_list[instance]['cheapest']
+        cheapest = cheapest_map[instance]
+
+        # No price could be fetched for this instance
+        if 'az' not in cheapest:
+            continue
 
         if max_price > cheapest['price']:
             return {
@@ -192,7 +798,10 @@ def select_spot_instance(role, size):
     cheapest = None
 
     for instance in possible_instances:
-        instance_cheapest = price_list[instance]['cheapest']
+        instance_cheapest = cheapest_map[instance]
+
+        if 'az' not in instance_cheapest:
+            continue
 
         if not cheapest or instance_cheapest['price'] < cheapest:
             cheapest = instance_cheapest['price']
@@ -203,17 +812,21 @@ def select_spot_instance(role, size):
                 'max_price': cheapest * 1.15
             }
 
-    return cheapest
+    if not selected:
+        raise Exception('No spot prices available for {}-{}'.format(role, size))
+
+    return selected
 
-def generate_launch_spec(role, spot, tag):
+def generate_launch_spec(role, spot, tag, metadata):
+    # `metadata` comes from `get_launch_metadata()`
     instance_type = spot['instance_type']
     max_price = spot['max_price']
     az = spot['az']
 
-    ami_id = role_map[role]['ami_id']
-    snapshot_id = role_map[role]['snapshot_id']
+    ami_id = metadata['images'][role]['ami_id']
+    snapshot_id = metadata['images'][role]['snapshot_id']
 
-    subnet_id = from_az_get_subnet(az)
+    subnet_id = metadata['subnets'][az]
 
     if instance_type.startswith('m4'):
         ebs_optimized = False
@@ -250,48 +863,148 @@ def generate_launch_spec(role, spot, tag):
 
 # AWS Helpers
 
-def get_instance_id_from_spot_request(spot_request_id):
+def get_instance_ids_from_spot_requests(spot_request_ids):
+    # Only loaded along with the client, like the rest of botocore
+    from botocore.exceptions import WaiterError
+
     waiter = ec2_client.get_waiter('spot_instance_request_fulfilled')
 
-    # Wait for request to be fulfilled
-    waiter.wait(
-        SpotInstanceRequestIds=[spot_request_id,],
-        WaiterConfig={'Delay': 3, 'MaxAttempts': 10}
+    # Wait for all requests to be fulfilled
+    try:
+        waiter.wait(
+            SpotInstanceRequestIds=spot_request_ids,
+            WaiterConfig={'Delay': 3, 'MaxAttempts': 10}
+        )
+    except WaiterError as e:
+        print('Not all spot requests were fulfilled: {}'.format(e))
+
+    # Fetch instance ids (of the ones that got one)
+    requests = ec2_client.describe_spot_instance_requests(
+        SpotInstanceRequestIds=spot_request_ids
+    )['SpotInstanceRequests']
+
+    return [request['InstanceId'] for request in requests if 'InstanceId' in request]
+
+def get_launch_metadata():
+    """Return the AMI/snapshot of every role and the subnet of every AZ.
+
+    From memory whenever possible, otherwise from `kv_cache`, and only looked
+    up on EC2 when both are missing or expired.
+    """
+    metadata = launch_metadata['metadata']
+
+    if metadata and metadata['expires_at'] > time.time():
+        return metadata
+
+    # A single lookup, even if a launch and a price refresh both need it
+    with launch_metadata_lock:
+        metadata = launch_metadata['metadata']
+
+        if metadata and metadata['expires_at'] > time.time():
+            return metadata
+
+        metadata = load_launch_metadata() or metadata
+
+        if not metadata or metadata['expires_at'] <= time.time():
+            metadata = resolve_launch_metadata(metadata)
+
+        launch_metadata['metadata'] = metadata
+
+        return metadata
+
+def load_launch_metadata():
+    resp = dynamo_client.get_item(
+        TableName=kv_cache_table,
+        Key={'key': {'S': launch_metadata_key}}
     )
 
-    # Fetch instance id
-    return ec2_client.describe_spot_instance_requests(
-        SpotInstanceRequestIds=[spot_request_id]
-    )['SpotInstanceRequests'][0]['InstanceId']
-
-def from_az_get_subnet(az):
-    if az == 'us-east-1a':
-        return 'subnet-2c82724b'
-    elif az == 'us-east-1b':
-        return 'subnet-16fb1a38'
-    elif az == 'us-east-1c':
-        return 'subnet-e7ce65ad'
-    elif az == 'us-east-1d':
-        return 'subnet-2d836471'
-    elif az == 'us-east-1e':
-        return 'subnet-49fffc76'
-    else:
-        return 'subnet-abd154a4'
+    if 'Item' not in resp:
+        return None
 
-def dict_to_item(raw):
-    """Transform a python element into a DynamoDB-compatible tuple"""
-    if isinstance(raw, dict):
-        return {
-            'M': {
-                k: dict_to_item(v)
-                for k, v in raw.items()
+    return dynamo_codec.decode(resp['Item']['value'])
+
+def resolve_launch_metadata(stale=None):
+    with metrics.phase('launch_metadata'):
+        try:
+            metadata = {
+                'images': lookup_images(),
+                'subnets': lookup_subnets(),
+                'expires_at': time.time() + launch_metadata_ttl
             }
-        }
-    elif isinstance(raw, list):
-        return {
-            'L': [dict_to_item(v) for v in raw]
-        }
-    elif isinstance(raw, str):
-        return {'S': raw}
-    elif isinstance(raw, int):
-        return {'N': str(raw)}
+        except Exception as e:
+            # Launches go on with what we had; retry in a bit
+            print('Unable to look up launch metadata: {}'.format(e))
+
+            return dict(
+                stale or default_launch_metadata(),
+                expires_at=time.time() + launch_metadata_retry
+            )
+
+        dynamo_client.put_item(
+            TableName=kv_cache_table,
+            Item=dynamo_codec.encode_item({
+                'key': launch_metadata_key,
+                'value': metadata
+            })
+        )
+
+    return metadata
+
+def default_launch_metadata():
+    return {
+        'images': {
+            role: {'ami_id': settings['ami_id'], 'snapshot_id': settings['snapshot_id']}
+            for role, settings in role_map.items()
+        },
+        'subnets': dict(default_subnets)
+    }
+
+def lookup_images():
+    # The latest available AMI tagged with each role, and its root snapshot
+    images = default_launch_metadata()['images']
+
+    resp = ec2_client.describe_images(
+        Owners=['self'],
+        Filters=[
+            {'Name': 'tag-key', 'Values': [image_role_tag]},
+            {'Name': 'state', 'Values': ['available']}
+        ]
+    )
+
+    found = set()
+
+    for image in sorted(resp['Images'], key=lambda image: image['CreationDate'], reverse=True):
+        tags = {tag['Key']: tag['Value'] for tag in image.get('Tags', [])}
+        role = tags.get(image_role_tag)
+
+        if role not in role_map or role in found:
+            continue
+
+        root = [
+            mapping['Ebs']['SnapshotId'] for mapping in image.get('BlockDeviceMappings', [])
+            if mapping['DeviceName'] == image.get('RootDeviceName') and 'Ebs' in mapping
+        ]
+
+        if not root:
+            continue
+
+        images[role] = {'ami_id': image['ImageId'], 'snapshot_id': root[0]}
+        found.add(role)
+
+    return images
+
+def lookup_subnets():
+    # The tagged subnet of each AZ (the one with most free addresses, if many)
+    resp = ec2_client.describe_subnets(
+        Filters=[
+            {'Name': 'tag-key', 'Values': [subnet_tag]},
+            {'Name': 'state', 'Values': ['available']}
+        ]
+    )
+
+    subnets = {}
+
+    for subnet in sorted(resp['Subnets'], key=lambda subnet: subnet['AvailableIpAddressCount']):
+        subnets[subnet['AvailabilityZone']] = subnet['SubnetId']
+
+    return subnets or dict(default_subnets)
@@ -1,28 +1,39 @@
-import boto3
-
-ec2_client = boto3.client('ec2', region_name='us-east-1')
+import metrics
+import slave_reaper
+import slave_registry
 
+@metrics.handler
 def lambda_handler(event, context):
     tag = event['tag']
 
-    query = ec2_client.describe_instances(
-        Filters=[
-            {
-                'Name': 'tag:jenkins_slave_tag',
-                'Values': [tag]
-            }
-        ],
-    )['Reservations']
-
-    print('Found {} matching instances on tag {}'.format(len(query), tag))
-
-    for instance in query:
-        data = instance['Instances'][0]
-        state_code = data['State']['Code']
-        instance_id = data['InstanceId']
-
-        if state_code == 16 or state_code == 0:
-            print('Terminating {}'.format(instance_id))
-            ec2_client.terminate_instances(InstanceIds=[instance_id])
+    with metrics.phase('find'):
+        entries = slave_registry.find_by_tag(tag)
+
+        if entries:
+            instances = slave_reaper.find_instances(
+                instance_ids=[entry['instance_id'] for entry in entries]
+            )
+
+        # Not on the registry (e.g. launched before it existed); look for the tag
         else:
-            print('Skipping because instance has code {}'.format(state_code))
+            instances = slave_reaper.find_instances([
+                {'Name': 'tag:jenkins_slave_tag', 'Values': [tag]}
+            ])
+
+    print('Found {} matching instances on tag {}'.format(len(instances), tag))
+
+    # Healthy pool slaves go back to their pool instead
+    with metrics.phase('reap'):
+        report, failed = slave_reaper.reap(instances)
+
+    print('Stopped slaves on tag {}: {}'.format(tag, report))
+
+    # Nothing runs under this tag anymore (slaves returned to their pool were
+    # registered again under the pool's tag), except for slaves that failed to
+    # terminate; they stay, so the next run (or the expirator) retries them
+    with metrics.phase('unregister'):
+        slave_registry.unregister([
+            entry for entry in entries if entry['instance_id'] not in failed
+        ])
+
+    return report
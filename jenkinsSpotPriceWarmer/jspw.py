@@ -0,0 +1,29 @@
+from datetime import datetime, timedelta
+import jsl
+import metrics
+
+# Meant to run on a schedule shortly before every hour (e.g. at HH:50), so the
+# next hour's `spot_price_cache` entry is already there when the launcher
+# needs it. Collection itself is shared with (and packaged from) the launcher.
+
+@metrics.handler
+def lambda_handler(_event, _context):
+    now = datetime.utcnow()
+    current_hour = now.replace(minute=0, second=0, microsecond=0)
+    next_hour = current_hour + timedelta(hours=1)
+
+    result = {}
+
+    for timestamp in [current_hour, next_hour]:
+        # Don't wait on someone else's collection; they'll cache it for us
+        prices = jsl.generate_spot_cache(timestamp, block=False)
+
+        if prices:
+            status = 'ready'
+        else:
+            status = 'skipped'
+
+        print('Spot prices for {}: {}'.format(timestamp, status))
+        result[str(timestamp)] = status
+
+    return result
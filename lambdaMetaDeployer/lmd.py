@@ -1,34 +1,196 @@
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import md5
-import base64
 import json
-import boto3
 import os
+import dynamo_batch
+import lambda_runtime
+import metrics
 
-lambda_client = boto3.client('lambda', region_name='us-east-1')
-dynamo_client = boto3.client('dynamodb', region_name='us-east-1')
+lambda_client = lambda_runtime.client('lambda')
 
 kv_cache_table = 'kv_cache'
 acc_number = os.environ['acc_number']
 
+# What functions run on, unless their config has a `runtime` (must match
+# deploy.py, which compiles their bytecode for it)
+default_runtime = 'python3.6'
+
+# Dependencies of every function are published as versions of this layer,
+# one per distinct set of dependencies
+layer_name = 'lambda_store_dependencies'
+
+# How many Lambda API calls run at once on a batch deploy
+max_concurrent_deploys = 8
+
+@metrics.handler
 def lambda_handler(event, context):
-    deploy(event['target_function'], event['zip_file'], event['config'])
+    if event.get('action') == 'probe':
+        return {'stale': probe(event['functions'])}
+
+    if event.get('action') == 'deploy':
+        return {'results': deploy_batch(event['functions'])}
+
+    # Layers shared by several deploy invokes, published before any of them
+    if event.get('action') == 'layers':
+        return {'layers': publish_layers_batch(event['functions'])}
+
+    # Single function payload
+    return {'results': deploy_batch([event])}
+
+def probe(functions):
+    """Return the functions whose zip or config hash differs from the cache.
+
+    Functions missing from the cache are always stale, since `deploy()` is the
+    one that figures out whether they need to be created or updated.
+    """
+    with metrics.phase('cache_read'):
+        cache = query_kv_cache_batch(cache_keys(functions))
+
+    stale = []
+
+    for function in functions:
+        function_name = function['target_function']
+
+        cached_zip_hash = cache.get(zip_cache_key(function_name), '')
+        cached_config_hash = cache.get(config_cache_key(function_name), '')
+
+        if cached_zip_hash != function['zip_hash'] \
+           or cached_config_hash != function['config_hash']:
+            stale.append(function_name)
+
+    return stale
+
+def deploy_batch(functions):
+    """Deploy several functions at once, returning a result for each one.
+
+    Cached hashes for every function are fetched (and later saved) with a
+    handful of batch requests, while the Lambda API calls of each function
+    run concurrently.
+    """
+    with metrics.phase('cache_read'):
+        cache = query_kv_cache_batch(cache_keys(functions))
+
+    # Functions often share layers; publish each one once, up front
+    with metrics.phase('layers'):
+        layer_arns, cache_updates = publish_layers(functions, cache)
+
+    def deploy_one(function):
+        function_name = function['target_function']
+        layer_hash = layer_arn = None
+
+        if function.get('layer'):
+            layer_hash = function['layer']['sha']
+            layer_arn = layer_arns[layer_hash]
+
+            if not layer_arn:
+                return 'error: publishing layer', {}
+
+        # Filled in as each call goes through, so whatever was deployed before
+        # an error still makes it to the cache
+        updates = {}
+
+        try:
+            result = deploy(
+                function_name, function['artifact'], function['config'], cache,
+                updates, layer_hash, layer_arn, function.get('force', False)
+            )
+        except Exception as e:
+            print('Error deploying {}: {}'.format(function_name, e))
+            result = 'error: {}'.format(e)
+
+        return result, updates
+
+    workers = max(min(len(functions), max_concurrent_deploys), 1)
+
+    with metrics.phase('deploy'), ThreadPoolExecutor(max_workers=workers) as executor:
+        deployed = list(executor.map(deploy_one, functions))
+
+    results = {}
+
+    for function, (result, updates) in zip(functions, deployed):
+        results[function['target_function']] = result
+        cache_updates.update(updates)
+
+    with metrics.phase('cache_write'):
+        update_kv_cache_batch(cache_updates)
+
+    return results
+
+def publish_layers_batch(functions):
+    # Returns the ARN of every layer of `functions` by hash (None on failure)
+    with metrics.phase('cache_read'):
+        cache = query_kv_cache_batch(cache_keys(functions))
+
+    with metrics.phase('layers'):
+        layer_arns, cache_updates = publish_layers(functions, cache)
+
+    with metrics.phase('cache_write'):
+        update_kv_cache_batch(cache_updates)
+
+    return layer_arns
+
+def publish_layers(functions, cache):
+    """Publish the layers of `functions` not published yet.
+
+    Returns the ARN of every layer by hash (None if it couldn't be published),
+    along with cache updates.
+    """
+    layer_arns = {}
+    cache_updates = {}
 
-def deploy(function_name, b64_zip_str, config):
-    zip_file = base64.b64decode(b64_zip_str)
+    for function in functions:
+        layer = function.get('layer')
 
-    zip_hash = md5(zip_file).hexdigest()
-    config_hash = md5(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+        if not layer or layer['sha'] in layer_arns:
+            continue
 
-    zip_cache_key = '{}#zip-hash'.format(function_name)
-    config_cache_key = '{}#config-hash'.format(function_name)
+        key = layer_cache_key(layer['sha'])
 
-    # Check if function has changed
-    zip_cache_query = query_kv_cache(zip_cache_key)
+        if key in cache:
+            layer_arns[layer['sha']] = cache[key]
+            continue
+
+        try:
+            resp = lambda_client.publish_layer_version(
+                LayerName=layer_name,
+                Description=layer['sha'],
+                Content={'S3Bucket': layer['bucket'], 'S3Key': layer['key']},
+                CompatibleRuntimes=[function['config'].get('runtime', default_runtime)]
+            )
+        except Exception as e:
+            print('Error publishing layer {}: {}'.format(layer['sha'], e))
+            layer_arns[layer['sha']] = None
+            continue
+
+        print('Layer {} published as {}'.format(layer['sha'], resp['LayerVersionArn']))
+
+        layer_arns[layer['sha']] = resp['LayerVersionArn']
+        cache_updates[key] = resp['LayerVersionArn']
+
+    return layer_arns, cache_updates
+
+def deploy(function_name, artifact, config, cache, cache_updates, layer_hash=None,
+           layer_arn=None, force=False):
+    """Create or update the function, returning its result.
+
+    `cache` holds the cached hashes, as returned by `query_kv_cache_batch()`,
+    and new hashes are added to `cache_updates` as soon as they're deployed.
+    Dependencies, if any, come on the layer `layer_arn`. With `force`, both
+    code and config are updated, whatever the cached hashes say.
+    """
+    # The package lives on S3 under a content-addressed key; Lambda fetches it
+    # from there directly, so we never need to download it ourselves
+    zip_hash = artifact['sha']
+    config_hash = get_config_hash(config, layer_hash)
+    layers = [layer_arn] if layer_arn else []
+
+    zip_key = zip_cache_key(function_name)
+    config_key = config_cache_key(function_name)
 
     # There already exists a cached entry for the function (meaning it exists!)
-    if 'Item' in zip_cache_query:
+    if zip_key in cache:
         action = 'update'
-        cached_zip_hash = zip_cache_query['Item']['value']['S']
+        cached_zip_hash = cache[zip_key]
 
     # If an entry was not found on the cache, let's check lambda itself. The
     # function may already exist, so we'd need to update it. Otherwise, we have
@@ -38,93 +200,138 @@ def deploy(function_name, b64_zip_str, config):
         cached_zip_hash = ''
 
     if action == 'update':
+        result = 'unchanged'
+        cached_config_hash = cache.get(config_key, '')
+
+        if force:
+            cached_zip_hash = cached_config_hash = ''
+
+        # Config goes first, so new code never runs without its (new) layer
+        if cached_config_hash == config_hash:
+            print('{} config hash hasn\'t changed'.format(function_name))
+
+        # Config is different; update it
+        else:
+            resp = lambda_client.update_function_configuration(
+                FunctionName=function_name,
+                Runtime=config.get('runtime', default_runtime),
+                MemorySize=config['memory'],
+                Timeout=config['timeout'],
+                Handler=config['handler'],
+                Layers=layers
+            )
+
+            if resp['ResponseMetadata']['HTTPStatusCode'] == 200:
+                # Save new hash on cache
+                cache_updates[config_key] = config_hash
+                result = 'updated'
+
+                print('{} config updated'.format(function_name))
+            else:
+                print('Error updating config {}: {}'.format(function_name, resp))
+                return 'error: updating config'
+
         # Zip file hasn't changed
         if cached_zip_hash == zip_hash:
             print('{} zip hash hasn\'t changed'.format(function_name))
 
         # Function was updated
         else:
+            # Lambda rejects updates while the previous one is in progress
+            if config_key in cache_updates:
+                lambda_client.get_waiter('function_updated').wait(
+                    FunctionName=function_name
+                )
+
             # Update code
             resp = lambda_client.update_function_code(
                 FunctionName=function_name,
-                ZipFile=zip_file,
+                S3Bucket=artifact['bucket'],
+                S3Key=artifact['key'],
                 Publish=True
             )
 
             if resp['ResponseMetadata']['HTTPStatusCode'] == 200:
                 # Save new hash on cache
-                update_kv_cache(zip_cache_key, zip_hash)
+                cache_updates[zip_key] = zip_hash
+                result = 'updated'
 
                 print('{} code updated'.format(function_name))
             else:
                 print('Error updating code {}: {}'.format(function_name, resp))
+                return 'error: updating code'
+
+        return result
 
     # Function doesn't exist; let's create it
+    resp = lambda_client.create_function(
+        FunctionName=function_name,
+        Runtime=config.get('runtime', default_runtime),
+        Role=derive_role(config, function_name),
+        Code={'S3Bucket': artifact['bucket'], 'S3Key': artifact['key']},
+        Handler=config['handler'],
+        Timeout=config['timeout'],
+        MemorySize=config['memory'],
+        Layers=layers,
+        Publish=True
+    )
+
+    if resp['ResponseMetadata']['HTTPStatusCode'] == 201:
+        # Save new function and config on cache
+        cache_updates[zip_key] = zip_hash
+        cache_updates[config_key] = config_hash
+
+        print('{} created'.format(function_name))
     else:
-        resp = lambda_client.create_function(
-            FunctionName=function_name,
-            Runtime='python3.6',
-            Role=derive_role(config, function_name),
-            Code={'ZipFile': zip_file},
-            Handler=config['handler'],
-            Timeout=config['timeout'],
-            MemorySize=config['memory'],
-            Publish=True
-        )
+        print('Error creating function {}: {}'.format(function_name, resp))
+        return 'error: creating function'
 
-        if resp['ResponseMetadata']['HTTPStatusCode'] == 201:
-            # Save new function and config on cache
-            update_kv_cache(zip_cache_key, zip_hash)
-            update_kv_cache(config_cache_key, config_hash)
+    return 'created'
 
-            print('{} created'.format(function_name))
-        else:
-            print('Error creating function {}: {}'.format(function_name, resp))
+def get_config_hash(config, layer_hash=None):
+    # Must match how deploy.py hashes configs. The layer is part of the
+    # function's configuration, so a new one means a config update.
+    if layer_hash:
+        config = dict(config, layer=layer_hash)
 
-        # No need to update the config; returning here...
-        return
+    return md5(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
 
-    config_cache_query = query_kv_cache(config_cache_key)
+def zip_cache_key(function_name):
+    return '{}#zip-hash'.format(function_name)
 
-    if 'Item' in config_cache_query:
-        cached_config_hash = config_cache_query['Item']['value']['S']
-    else:
-        cached_config_hash = ''
+def config_cache_key(function_name):
+    return '{}#config-hash'.format(function_name)
 
-    # Config hasn't changed
-    if cached_config_hash == config_hash:
-        print('{} config hash hasn\'t changed'.format(function_name))
+def layer_cache_key(layer_hash):
+    return 'layer#{}'.format(layer_hash)
 
-    # Config is different; update it
-    else:
-        # Update config
-        resp = lambda_client.update_function_configuration(
-            FunctionName=function_name,
-            MemorySize=config['memory'],
-            Timeout=config['timeout'],
-            Handler=config['handler']
-        )
+def cache_keys(functions):
+    keys = []
 
-        if resp['ResponseMetadata']['HTTPStatusCode'] == 200:
-            # Save new hash on cache
-            update_kv_cache(config_cache_key, config_hash)
-            
-            print('{} config updated'.format(function_name))
-        else:
-            print('Error updating config {}: {}'.format(function_name, resp))
+    for function in functions:
+        keys.append(zip_cache_key(function['target_function']))
+        keys.append(config_cache_key(function['target_function']))
 
-def query_kv_cache(key):
-    return dynamo_client.get_item(
-        TableName=kv_cache_table,
-        Key={'key': {'S': key}}
-    )
+        if function.get('layer'):
+            keys.append(layer_cache_key(function['layer']['sha']))
+
+    return keys
 
-def update_kv_cache(key, value):
-    return dynamo_client.put_item(
-        TableName=kv_cache_table,
-        Item={'key': {'S': key}, 'value': {'S': value}}
+def query_kv_cache_batch(keys):
+    """Fetch many keys from the cache, returning a dict of the ones found"""
+    # Duplicated keys are rejected by `batch_get_item`
+    items = dynamo_batch.get_items(
+        kv_cache_table, [{'key': {'S': key}} for key in sorted(set(keys))]
     )
 
+    return {item['key']['S']: item['value']['S'] for item in items}
+
+def update_kv_cache_batch(values):
+    dynamo_batch.write_items(kv_cache_table, [
+        {'PutRequest': {'Item': {'key': {'S': key}, 'value': {'S': value}}}}
+        for key, value in sorted(values.items())
+    ])
+
 def derive_role(config, function_name):
     if 'role_name' in config:
         role_name = config['role_name']
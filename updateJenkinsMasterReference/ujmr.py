@@ -1,45 +1,182 @@
 import os
-from base64 import b64decode
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import CloudFlare
-import boto3
+import lambda_runtime
+import metrics
 
 EMAIL = os.environ['UJMR_EMAIL']
 API_KEY_ENC = os.environ['UJMR_API_KEY']
-API_KEY = boto3.client('kms').decrypt(CiphertextBlob=b64decode(API_KEY_ENC))['Plaintext']
 
 zone_name = 'hackerexperience.com'
 external_name = 'ci.' + zone_name
 internal_name = 'internal.' + external_name
 
-# Authenticate with CF
-cf = CloudFlare.CloudFlare(email=EMAIL, token=API_KEY)
+dynamo_client = lambda_runtime.client('dynamodb')
 
+kv_cache_table = 'kv_cache'
+records_cache_key = 'ujmr#records'
+
+# The zone/record IDs and what the records hold. Someone may change a record
+# by hand, so after a while we look them up on CloudFlare again.
+records_cache = {'records': None}
+records_cache_ttl = 3600
+
+# CF client, only created (and its API key decrypted) once we need it
+cf_client = {'client': None}
+cf_client_lock = threading.Lock()
+
+@metrics.handler
 def lambda_handler(event, context):
 
     # Event values (input)
     new_external_ip = event['external_ip']
     new_internal_ip = event['internal_ip']
 
+    # Generate new DNS records
+    new_records = {
+        external_name: gen_new_dns_record(external_name, new_external_ip),
+        internal_name: gen_new_dns_record(internal_name, new_internal_ip, False)
+    }
+
+    records, cached = load_records()
+
+    try:
+        update_records(records, new_records)
+
+    # The cached IDs may be stale (e.g. the record was recreated); look them up
+    # again and retry once
+    except CloudFlare.exceptions.CloudFlareAPIError as e:
+        if not cached:
+            exit('/zones.dns_records.put %d %s - api call failed' % (e, e))
+
+        print('Update failed with cached records ({}); resolving them again'.format(e))
+
+        records = resolve_records()
+
+        try:
+            update_records(records, new_records)
+        except CloudFlare.exceptions.CloudFlareAPIError as e:
+            exit('/zones.dns_records.put %d %s - api call failed' % (e, e))
+
+def update_records(records, new_records):
+    # Only records that don't hold the new IP yet need a PUT
+    stale = [
+        name for name, new_record in sorted(new_records.items())
+        if not same_record(records['records'][name], new_record)
+    ]
+
+    if not stale:
+        print('DNS records are up to date')
+        return
+
+    def update_one(name):
+        record = records['records'][name]
+
+        update_record(get_cf(), records['zone_id'], record['id'], new_records[name])
+
+        record['content'] = new_records[name]['content']
+        record['proxied'] = new_records[name]['proxied']
+
+        print('{} now points to {}'.format(name, record['content']))
+
+    with metrics.phase('update_records'), ThreadPoolExecutor(max_workers=len(stale)) as executor:
+        # Consume the results so errors are raised here
+        list(executor.map(update_one, stale))
+
+    save_records(records)
+
+def same_record(record, new_record):
+    return record['content'] == new_record['content'] \
+        and record['proxied'] == new_record['proxied']
+
+def load_records():
+    """Return the cached zone/record entries, and whether they came from a cache.
+
+    Warm containers keep them in memory; otherwise they're read from
+    `kv_cache`, and only looked up on CloudFlare when both are missing or
+    expired.
+    """
+    now = time.time()
+
+    records = records_cache['records']
+
+    if records and records['expires_at'] > now:
+        return records, True
+
+    resp = dynamo_client.get_item(
+        TableName=kv_cache_table,
+        Key={'key': {'S': records_cache_key}}
+    )
+
+    if 'Item' in resp:
+        records = json.loads(resp['Item']['value']['S'])
+
+        if records['expires_at'] > now:
+            records_cache['records'] = records
+            return records, True
+
+    return resolve_records(), False
+
+def resolve_records():
+    with metrics.phase('resolve_records'):
+        return lookup_records()
+
+def lookup_records():
+    cf = get_cf()
+
     # Get zone
     zone_id = get_zone(cf, zone_name)[0]['id']
 
+    records = {
+        'zone_id': zone_id,
+        'records': {},
+        'expires_at': time.time() + records_cache_ttl
+    }
+
     # Get DNS records
-    external_record_id = get_dns_record(cf, zone_id, external_name)[0]['id']
-    internal_record_id = get_dns_record(cf, zone_id, internal_name)[0]['id']
+    for name in [external_name, internal_name]:
+        record = get_dns_record(cf, zone_id, name)[0]
 
-    # Generate new DNS records
-    new_external_record = gen_new_dns_record(external_name, new_external_ip)
-    new_internal_record = gen_new_dns_record(internal_name, new_internal_ip, False)
+        records['records'][name] = {
+            'id': record['id'],
+            'content': record['content'],
+            'proxied': record['proxied']
+        }
+
+    save_records(records)
+
+    return records
 
-    # Update DNS records
-    update_record(cf, zone_id, external_record_id, new_external_record)
-    update_record(cf, zone_id, internal_record_id, new_internal_record)
+def save_records(records):
+    records_cache['records'] = records
+
+    dynamo_client.put_item(
+        TableName=kv_cache_table,
+        Item={
+            'key': {'S': records_cache_key},
+            'value': {'S': json.dumps(records, sort_keys=True)}
+        }
+    )
+
+def get_cf():
+    # Authenticate with CF
+    with cf_client_lock:
+        if cf_client['client'] is None:
+            with metrics.phase('decrypt'):
+                api_key = lambda_runtime.decrypt(API_KEY_ENC)
+            cf_client['client'] = CloudFlare.CloudFlare(email=EMAIL, token=api_key)
+
+        return cf_client['client']
 
 # Helper methods
 
 def get_zone(cf, name):
     try:
-        return cf.zones.get(params={'name': name})
+        with metrics.call('cloudflare.GetZones'):
+            return cf.zones.get(params={'name': name})
     except CloudFlare.exceptions.CloudFlareAPIError as e:
         exit('/zones %d %s - api call failed' % (e, e))
     except Exception as e:
@@ -48,15 +185,15 @@ def get_zone(cf, name):
 def get_dns_record(cf, zone_id, name, dns_type = 'A'):
     try:
         params = {'name': name, 'match': 'all', 'type': dns_type}
-        return cf.zones.dns_records.get(zone_id, params=params)
+        with metrics.call('cloudflare.GetDNSRecords'):
+            return cf.zones.dns_records.get(zone_id, params=params)
     except CloudFlare.exceptions.CloudFlareAPIError as e:
         exit('/zones/dns_records %s - %d %s - api call failed' % (name, e, e))
 
 def update_record(cf, zone_id, record_id, new_record):
-    try:
+    # Errors are handled by the caller, which may retry with fresh record IDs
+    with metrics.call('cloudflare.PutDNSRecord'):
         return cf.zones.dns_records.put(zone_id, record_id, data=new_record)
-    except CloudFlare.exceptions.CloudFlareAPIError as e:
-        exit('/zones.dns_records.post %s - %d %s - api call failed' % (record_id, e, e))
 
 def gen_new_dns_record(name, new_ip, proxied = True):
     return {